@@ -7,11 +7,25 @@ The paper can be found online at:
     http://research.microsoft.com/en-us/um/people/kopf/pixelart/
 """
 
+from collections import deque
+from heapq import heappop, heappush
+from itertools import chain, compress
 from math import sqrt
+import multiprocessing
+import zlib
 
 import networkx as nx
 
 from depixel import bspline
+from depixel.mesh import HalfEdgeMesh, LATTICE_SCALE, lattice_point
+from depixel.pixelgraph import (
+    PixelGraph, build_links, match_masks, similarity_masks, shifted_rows,
+    classify_blocks, block_diagonals, default_corners, direction_between,
+    label_components, rgb_to_yuv, FORWARD_DIRECTIONS, NEIGHBOURS,
+    YUV_THRESHOLDS, E, SE, S, SW)
+
+
+BACKGROUND_FROM_BORDER = 'border'
 
 
 def gen_coords(size):
@@ -20,14 +34,11 @@ def gen_coords(size):
             yield (x, y)
 
 
-def within_bounds(coord, size, offset=(0, 0)):
-    x, y = map(sum, zip(coord, offset))
-    size_x, size_y = size
-    return (0 <= x < size_x and 0 <= y < size_y)
-
-
 def cn_edge(edge):
-    return tuple(sorted(edge[:2]))
+    a, b = edge[:2]
+    if b < a:
+        return (b, a)
+    return (a, b)
 
 
 def distance(p0, p1):
@@ -43,9 +54,407 @@ def gradient(p0, p1):
     return 1.0 * dy / dx
 
 
-def remove_from_set(things, thing):
-    things.add(thing)
-    things.remove(thing)
+def signed_area(points):
+    """
+    Twice the signed area of a closed polygon. This is positive if the points
+    go around the same way as the pixel cells do.
+    """
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(
+        points, points[1:] + points[:1]))
+
+
+def control_vertices(vertices, corner_length=None):
+    """
+    Pick the control points for a spline around a closed outline.
+
+    A quadratic B-spline is straight wherever three control points in a row
+    are, so in a straight run of vertices we only need the two at each end
+    to get exactly the same curve. Sharp corners, where the outline turns
+    through a right angle or more in less than `corner_length` between
+    straight runs at least that long, get two control points at every
+    vertex so the curve follows them exactly instead of rounding them off.
+    """
+    count = len(vertices)
+    turns = []
+    for i, (x1, y1) in enumerate(vertices):
+        x0, y0 = vertices[i - 1]
+        x2, y2 = vertices[(i + 1) % count]
+        dx0, dy0, dx1, dy1 = x1 - x0, y1 - y0, x2 - x1, y2 - y1
+        if dx0 * dy1 != dy0 * dx1 or dx0 * dx1 + dy0 * dy1 <= 0:
+            turns.append(i)
+    if not turns:
+        return list(vertices)
+
+    runs = len(turns)
+    corners = [False] * runs
+    if corner_length is not None:
+        directions = []
+        for j, turn in enumerate(turns):
+            x0, y0 = vertices[turn]
+            x1, y1 = vertices[turns[(j + 1) % runs]]
+            directions.append((x1 - x0, y1 - y0))
+        lengths = [sqrt(dx * dx + dy * dy) for dx, dy in directions]
+        for j, (dx0, dy0) in enumerate(directions):
+            if lengths[j] < corner_length:
+                continue
+            # Look for the next long run, as long as we don't go too far.
+            between = 0
+            for offset in range(1, runs):
+                k = (j + offset) % runs
+                if lengths[k] >= corner_length:
+                    dx1, dy1 = directions[k]
+                    if dx0 * dx1 + dy0 * dy1 <= 0:
+                        for turn in range(j + 1, j + offset + 1):
+                            corners[turn % runs] = True
+                    break
+                between += lengths[k]
+                if between >= corner_length:
+                    break
+
+    control = []
+    for j, start in enumerate(turns):
+        end = turns[(j + 1) % runs]
+        if end <= start:
+            end += count
+        control.append(vertices[start])
+        if corners[j]:
+            control.append(vertices[start])
+        # The vertices next to a corner don't matter, because the curve is
+        # already straight on both sides of it.
+        keep = []
+        if start + 1 < end and not corners[j]:
+            keep.append(start + 1)
+        if (start + 1 < end and not corners[(j + 1) % runs]
+                and end - 1 not in keep):
+            keep.append(end - 1)
+        control.extend(vertices[i % count] for i in keep)
+    return control
+
+
+def smooth_spline_job(job):
+    """
+    Smooth a spline, possibly in another process.
+
+    `job` is a `(smoother, spline, seed)` tuple, and we return the smooth
+    spline and the smoother's stats.
+    """
+    smoother, spline, seed = job
+    smoother = smoother(spline, seed)
+    smoother.smooth()
+    return smoother.spline, smoother.stats()
+
+
+def offset_coord(coord, offset):
+    if offset == (0, 0):
+        return coord
+    return (coord[0] + offset[0], coord[1] + offset[1])
+
+
+def link_mask(graph, node):
+    """
+    Get a bitmask of the directions a node is linked in.
+
+    This works for both `networkx` graphs and our own `PixelGraph`.
+    """
+    if not isinstance(graph, nx.Graph):
+        return graph.link_mask(node)
+    mask = 0
+    for neighbor in graph.neighbors(node):
+        mask |= 1 << direction_between(node, neighbor)
+    return mask
+
+
+# The pixels around a lattice vertex, as offsets from the vertex.
+VERTEX_PIXELS = ((-1, -1), (0, -1), (-1, 0), (0, 0))
+TL, TR, BL, BR = range(4)
+
+# The lattice edges leaving a vertex, going north, east, south and west.
+EDGE_N, EDGE_E, EDGE_S, EDGE_W = range(4)
+
+# The lattice edges each pixel's boundary arrives at a vertex along and leaves
+# it along, going clockwise around the pixel.
+CELL_EDGES = (
+    (EDGE_N, EDGE_W), (EDGE_E, EDGE_N), (EDGE_W, EDGE_S), (EDGE_S, EDGE_E))
+
+# The diagonals that can cross at a vertex, with the pixels whose corners
+# each one cuts across.
+NO_DIAGONAL, DIAGONAL_TL_BR, DIAGONAL_TR_BL = range(3)
+CUT_PIXELS = ((), (TR, BL), (TL, BR))
+
+
+def vertex_pattern(diagonal, matches):
+    """
+    Work out the deformed grid around a lattice vertex.
+
+    :param diagonal: The diagonal, if any, that crosses at the vertex.
+    :param matches: A bitmask with a bit set for each lattice edge whose two
+        pixels match, indexed by `EDGE_N` and friends.
+
+    Where the diagonal cuts across the corner of a pixel it doesn't match, the
+    lattice edges between them end a quarter of the way into that pixel
+    rather than at the vertex, and that new corner is joined to the vertex.
+    Offsets are in lattice units, so a quarter of a pixel is 1.
+    If both of the pixel's edges are cut, it no longer reaches the vertex.
+
+    Returns the corners each pixel has here in clockwise order, indexed by
+    `TL` and friends, as offsets from the vertex.
+    """
+    # Where each lattice edge ends.
+    ends = [(0, 0)] * 4
+    for cut_pixel in CUT_PIXELS[diagonal]:
+        px, py = VERTEX_PIXELS[cut_pixel]
+        cut = (2 * px + 1, 2 * py + 1)
+        for edge in CELL_EDGES[cut_pixel]:
+            if not matches >> edge & 1:
+                ends[edge] = cut
+
+    corners = []
+    for in_edge, out_edge in CELL_EDGES:
+        pixel_corners = [ends[in_edge]]
+        if ends[in_edge] != ends[out_edge]:
+            pixel_corners.extend([(0, 0), ends[out_edge]])
+        corners.append(tuple(
+            corner for i, corner in enumerate(pixel_corners)
+            if corner not in pixel_corners[:i]))
+    return tuple(corners)
+
+
+# Every possible pattern, indexed by `diagonal << 4 | matches`.
+VERTEX_PATTERNS = tuple(
+    vertex_pattern(diagonal, matches)
+    for diagonal in (NO_DIAGONAL, DIAGONAL_TL_BR, DIAGONAL_TR_BL)
+    for matches in range(16))
+
+
+class CurveChains(object):
+    """
+    An index of the single-pixel-wide curves in a pixel graph.
+
+    A curve is a chain of edges joined by valence-2 nodes. Each chain is only
+    walked once, the first time we ask about any of its edges, and every edge
+    in it then shares the same chain. Edges must be removed through this
+    index so that it can forget any chains that the removal changes.
+    """
+
+    def __init__(self, pixel_graph):
+        self.pixel_graph = pixel_graph
+        self._chains = {}
+
+    def chain(self, edge):
+        """
+        Get the set of edges in the curve containing the given edge.
+        """
+        edge = cn_edge(edge)
+        chain = self._chains.get(edge)
+        if chain is None:
+            chain = self._walk_chain(edge)
+            if self.pixel_graph.has_edge(*edge):
+                # We can't cache chains for edges that aren't in the graph,
+                # because they aren't really chains.
+                for chain_edge in chain:
+                    self._chains[chain_edge] = chain
+        return chain
+
+    def length(self, edge):
+        return len(self.chain(edge))
+
+    def _walk_chain(self, edge):
+        seen_edges = set([edge])
+        nodes = list(edge)
+
+        while nodes:
+            node = nodes.pop()
+            if self.pixel_graph.degree(node) != 2:
+                # This node is not part of a curve
+                continue
+            for neighbor in self.pixel_graph.neighbors(node):
+                edge = cn_edge((node, neighbor))
+                if edge not in seen_edges:
+                    seen_edges.add(edge)
+                    nodes.append(neighbor)
+        return frozenset(seen_edges)
+
+    def remove_edge(self, edge):
+        """
+        Remove an edge from the graph and forget any chains it affects.
+
+        Removing an edge changes the valence of both its nodes, so any chain
+        that touches either of them may now be different.
+        """
+        pix0, pix1 = edge[:2]
+        self.pixel_graph.remove_edge(pix0, pix1)
+        stale_edges = [cn_edge(edge)]
+        for node in (pix0, pix1):
+            stale_edges.extend(
+                cn_edge((node, neighbor))
+                for neighbor in self.pixel_graph.neighbors(node))
+        for stale_edge in stale_edges:
+            for chain_edge in self._chains.get(stale_edge, ()):
+                self._chains.pop(chain_edge, None)
+
+
+class SparseWindows(object):
+    """
+    Connected component sizes within sparse feature windows.
+
+    Every ambiguous block has a window of pixels around it, shared by both of
+    its diagonals. Components are labelled within each window as they are
+    needed and the labels are kept. A component that never reaches the edge
+    of its window is a whole component of the graph, so any other window it
+    fits in can use it without flooding. Edge removals must be passed on
+    through `forget` so that anything they affect can be thrown away.
+    """
+
+    def __init__(self, pixel_graph, window_size):
+        self.pixel_graph = pixel_graph
+        self.window_size = window_size
+        self._windows = {}
+        # The origins of the windows each node has been labelled in.
+        self._node_windows = {}
+        # Whole components, as [size, bounds] lists shared by their nodes.
+        self._components = {}
+
+    def window_origin(self, edge):
+        return (min(edge[0][0], edge[1][0]) - (self.window_size[0] // 2 - 1),
+                min(edge[0][1], edge[1][1]) - (self.window_size[1] // 2 - 1))
+
+    def component_size(self, edge):
+        """
+        Count the pixels connected to either end of an edge within its window.
+        """
+        origin = self.window_origin(edge)
+        labels = self._windows.setdefault(origin, {})
+        components = []
+        for node in edge[:2]:
+            component = labels.get(node)
+            if component is None:
+                component = self._whole_component(origin, node)
+            if component is None:
+                component = self._label_component(origin, node, labels)
+            if not any(c is component for c in components):
+                components.append(component)
+        return sum(component[0] for component in components)
+
+    def _whole_component(self, origin, node):
+        component = self._components.get(node)
+        if not component:
+            return None
+        min_x, min_y, max_x, max_y = component[1]
+        if (origin[0] <= min_x and max_x < origin[0] + self.window_size[0]
+                and origin[1] <= min_y
+                and max_y < origin[1] + self.window_size[1]):
+            return component
+        return None
+
+    def _label_component(self, origin, node, labels):
+        min_x, min_y = origin
+        max_x = min_x + self.window_size[0]
+        max_y = min_y + self.window_size[1]
+        component = [0, None]
+        labels[node] = component
+        members = [node]
+        nodes = [node]
+        whole = True
+
+        while nodes:
+            for n in self.pixel_graph.neighbors(nodes.pop()):
+                if n in labels:
+                    continue
+                if min_x <= n[0] < max_x and min_y <= n[1] < max_y:
+                    labels[n] = component
+                    members.append(n)
+                    nodes.append(n)
+                else:
+                    whole = False
+
+        component[0] = len(members)
+        for n in members:
+            self._node_windows.setdefault(n, set()).add(origin)
+        if whole:
+            xs = [n[0] for n in members]
+            ys = [n[1] for n in members]
+            component[1] = (min(xs), min(ys), max(xs), max(ys))
+            for n in members:
+                self._components[n] = component
+        return component
+
+    def forget(self, edge):
+        """
+        Throw away all windows and whole components containing either end of
+        an edge.
+        """
+        for node in edge[:2]:
+            for origin in self._node_windows.pop(node, ()):
+                self._windows.pop(origin, None)
+            component = self._components.pop(node, None)
+            if component:
+                # The rest of its nodes still point at it.
+                del component[:]
+
+
+class WindowPatterns(object):
+    """
+    Memoised weights for local connectivity patterns.
+
+    Dithered regions repeat the same few patterns over and over, so we key
+    the weights on the links within the sparse feature window around an edge,
+    along with where the edge sits in that window. The links include the
+    valences of the edge's ends, so the island weight is covered as well.
+    `hits` and `misses` count how well the cache is doing.
+
+    A `PixelGraph` can hand us a window's links directly. For anything else,
+    we keep the link mask of each node we've looked at, so edge removals must
+    be passed on through `forget`.
+    """
+
+    def __init__(self, pixel_graph, window_size):
+        self.pixel_graph = pixel_graph
+        self.window_size = window_size
+        self._weights = {}
+        self._masks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, edge, origin):
+        (x0, y0), (x1, y1) = cn_edge(edge)
+        min_x, min_y = origin
+        return (self.window_links(origin),
+                (x0 - min_x, y0 - min_y, x1 - min_x, y1 - min_y))
+
+    def window_links(self, origin):
+        if isinstance(self.pixel_graph, PixelGraph):
+            return self.pixel_graph.window_links(origin, self.window_size)
+        min_x, min_y = origin
+        size_x, size_y = self.window_size
+        masks = bytearray()
+        for y in range(min_y, min_y + size_y):
+            for x in range(min_x, min_x + size_x):
+                mask = self._masks.get((x, y))
+                if mask is None:
+                    mask = 0
+                    if (x, y) in self.pixel_graph:
+                        mask = link_mask(self.pixel_graph, (x, y))
+                    self._masks[(x, y)] = mask
+                masks.append(mask)
+        return bytes(masks)
+
+    def weights(self, edge, origin, calculate):
+        """
+        Get the weights for an edge, calling `calculate` if we haven't seen
+        its pattern before.
+        """
+        key = self.key(edge, origin)
+        weights = self._weights.get(key)
+        if weights is None:
+            self.misses += 1
+            weights = self._weights[key] = calculate(edge)
+        else:
+            self.hits += 1
+        return weights
+
+    def forget(self, edge):
+        for node in edge[:2]:
+            self._masks.pop(node, None)
 
 
 class DiagonalResolutionHeuristics(object):
@@ -53,17 +462,28 @@ class DiagonalResolutionHeuristics(object):
 
     def __init__(self, pixel_graph):
         self.pixel_graph = pixel_graph
+        self.curve_chains = CurveChains(pixel_graph)
+        self.sparse_windows = SparseWindows(
+            pixel_graph, self.SPARSE_WINDOW_SIZE)
 
-    def sparse_window_offset(self, edge):
-        return (
-            self.SPARSE_WINDOW_SIZE[0] / 2 - 1 - min((edge[0][0], edge[1][0])),
-            self.SPARSE_WINDOW_SIZE[1] / 2 - 1 - min((edge[0][1], edge[1][1])))
+    def remove_edge(self, edge):
+        self.curve_chains.remove_edge(edge)
+        self.sparse_windows.forget(edge)
 
     def apply(self, blocks):
         raise NotImplementedError()
 
 
 class FullyConnectedHeuristics(DiagonalResolutionHeuristics):
+    def __init__(self, pixel_graph):
+        super(FullyConnectedHeuristics, self).__init__(pixel_graph)
+        self.window_patterns = WindowPatterns(
+            pixel_graph, self.SPARSE_WINDOW_SIZE)
+
+    def remove_edge(self, edge):
+        super(FullyConnectedHeuristics, self).remove_edge(edge)
+        self.window_patterns.forget(edge)
+
     def apply(self, diagonal_pairs):
         """
         Iterate over the set of ambiguous diagonals and resolve them.
@@ -75,7 +495,7 @@ class FullyConnectedHeuristics(DiagonalResolutionHeuristics):
             min_weight = min(e[2]['h_weight'] for e in edges)
             for edge in edges:
                 if edge[2]['h_weight'] == min_weight:
-                    self.pixel_graph.remove_edge(*edge[:2])
+                    self.remove_edge(edge)
                 else:
                     edge[2].pop('h_weight')
 
@@ -90,13 +510,19 @@ class FullyConnectedHeuristics(DiagonalResolutionHeuristics):
         """
         Apply heuristics to an ambiguous diagonal.
         """
-        weights = [
-            self.weight_curve(edge),
-            self.weight_sparse(edge),
-            self.weight_island(edge),
-            ]
+        weights = [self.weight_curve(edge)]
+        weights.extend(self.weight_window(edge))
         edge[2]['h_weight'] = sum(weights)
 
+    def weight_window(self, edge):
+        """
+        Apply the heuristics that only look inside the sparse feature window,
+        reusing the weights for any pattern we've already seen.
+        """
+        return self.window_patterns.weights(
+            edge, self.sparse_windows.window_origin(edge),
+            lambda e: (self.weight_sparse(e), self.weight_island(e)))
+
     def weight_curve(self, edge):
         """
         Weight diagonals based on curve length.
@@ -104,21 +530,7 @@ class FullyConnectedHeuristics(DiagonalResolutionHeuristics):
         Edges that are part of long single-pixel-wide features are
         more likely to be important.
         """
-        seen_edges = set([cn_edge(edge)])
-        nodes = list(edge[:2])
-
-        while nodes:
-            node = nodes.pop()
-            edges = self.pixel_graph.edges(node, data=True)
-            if len(edges) != 2:
-                # This node is not part of a curve
-                continue
-            for edge in edges:
-                edge = cn_edge(edge)
-                if edge not in seen_edges:
-                    seen_edges.add(edge)
-                    nodes.extend(n for n in edge if n != node)
-        return len(seen_edges)
+        return self.curve_chains.length(edge)
 
     def weight_sparse(self, edge):
         """
@@ -128,21 +540,7 @@ class FullyConnectedHeuristics(DiagonalResolutionHeuristics):
         rather than "background", and are therefore likely to be more
         important.
         """
-
-        nodes = list(edge[:2])
-        seen_nodes = set(nodes)
-        offset = self.sparse_window_offset(edge)
-
-        while nodes:
-            node = nodes.pop()
-            for n in self.pixel_graph.neighbors(node):
-                if n in seen_nodes:
-                    continue
-                if within_bounds(n, self.SPARSE_WINDOW_SIZE, offset=offset):
-                    seen_nodes.add(n)
-                    nodes.append(n)
-
-        return -len(seen_nodes)
+        return -self.sparse_windows.component_size(edge)
 
     def weight_island(self, edge):
         """
@@ -158,43 +556,130 @@ class FullyConnectedHeuristics(DiagonalResolutionHeuristics):
 
 
 class IterativeFinalShapeHeuristics(DiagonalResolutionHeuristics):
+    """
+    Resolve ambiguous diagonals based on what the final shapes could be.
+
+    Each heuristic gives a range of possible weights for a diagonal, covering
+    every way the other ambiguous diagonals might still be resolved. A pair is
+    only resolved when the ranges show a clear winner. Resolving a pair can
+    narrow the ranges of other pairs nearby, so those go back on the worklist.
+    When the worklist runs dry, the pair whose midpoints are furthest apart is
+    forced on those and the pairs around it go back on the worklist, since
+    that might be all they were waiting for.
+
+    Curve weights stop growing at `MAX_CURVE_LENGTH`. Past that a curve is
+    just long, and capping the walks keeps both their cost and the number of
+    pairs each resolution sends back to the worklist under control.
+    """
+
+    MAX_CURVE_LENGTH = 64
+
+    def __init__(self, pixel_graph):
+        super(IterativeFinalShapeHeuristics, self).__init__(pixel_graph)
+        self.ambiguous = set()
+        self._curve_extents = {}
+        self._link_cache = {}
+
     def apply(self, diagonal_pairs):
         """
         Iterate over the set of ambiguous diagonals and resolve them.
         """
-        new_pairs = []
-
-        for edges in diagonal_pairs:
-            for edge in edges:
-                edge[2]['ambiguous'] = True
+        pending = set()
+        blocks = {}
+        for i, edges in enumerate(diagonal_pairs):
+            pending.add(i)
+            blocks[self.pair_block(edges)] = i
+            self.ambiguous.update(cn_edge(edge) for edge in edges)
+
+        watchers = {}
+        worklist = deque(sorted(pending))
+        queued = set(pending)
+        # Ambiguous pairs by how far apart their midpoints are, largest first,
+        # and those that something nearby has been forced on since.
+        margins = {}
+        undecided = []
+        stale = set()
+
+        while worklist or undecided:
+            if worklist:
+                i = worklist.popleft()
+                queued.discard(i)
+                if i not in pending:
+                    continue
 
-        for edges in diagonal_pairs:
-            removals = self.weight_diagonals(*edges)
-            if removals is None:
-                # Nothing to remove, so we're still ambiguous.
-                new_pairs.append(edges)
+                edges = diagonal_pairs[i]
+                removals = self.weight_diagonals(*edges)
+                forced = False
+                stale.discard(i)
+                if removals is None:
+                    # Still ambiguous, so wait for something nearby to change.
+                    for edge in edges:
+                        for node in chain.from_iterable(
+                                self._curve_extents.get(cn_edge(edge), ())):
+                            watchers.setdefault(node, set()).add(i)
+                    margins[i] = -self.fallback_margin(*edges)
+                    heappush(undecided, (margins[i], i))
+                    continue
+            else:
+                # Every pair left is still ambiguous, so force the one that
+                # is closest to being decided. If something near it has been
+                # forced since it was weighed, weigh it again first.
+                margin, i = heappop(undecided)
+                if i not in pending or margins[i] != margin:
+                    continue
+                if i in stale:
+                    worklist.append(i)
+                    queued.add(i)
+                    continue
+                edges = diagonal_pairs[i]
+                removals = self.fallback_removals(*edges)
+                forced = True
+
+            pending.discard(i)
+            self.resolve(edges, removals)
+
+            # Anything that might have been looking at this block needs
+            # another look.
+            affected = set()
+            for node in set(chain.from_iterable(e[:2] for e in edges)):
+                affected.update(watchers.pop(node, ()))
+                affected.update(self._window_blocks(node, blocks))
+            if forced:
+                # Weighing everything around every forced pair adds up fast
+                # in dithered regions, so they wait until they're next up.
+                stale.update(affected & pending)
                 continue
+            for j in sorted(affected & pending - queued):
+                worklist.append(j)
+                queued.add(j)
 
-            for edge in edges:
-                if edge in removals:
-                    # Remove this edge
-                    self.pixel_graph.remove_edge(edge[0], edge[1])
-                else:
-                    # Clean up other edges
-                    edge[2].pop('h_weight')
-                    edge[2].pop('ambiguous')
-
-        # Reiterate if necessary.
-        if not new_pairs:
-            # Nothing more to do, let's go home.
-            return
-        elif new_pairs == diagonal_pairs:
-            # No more unambiguous pairs.
-            # TODO: Handle this gracefully.
-            raise ValueError("No more unambiguous blocks.")
-        else:
-            # Try again.
-            self.apply(new_pairs)
+    def pair_block(self, edges):
+        return (min(edges[0][0][0], edges[0][1][0]),
+                min(edges[0][0][1], edges[0][1][1]))
+
+    def _window_blocks(self, node, blocks):
+        """
+        Find the pairs whose sparse windows contain the given node.
+        """
+        size_x, size_y = self.SPARSE_WINDOW_SIZE
+        x, y = node
+        for bx in range(x - size_x + size_x // 2, x + size_x // 2):
+            for by in range(y - size_y + size_y // 2, y + size_y // 2):
+                if (bx, by) in blocks:
+                    yield blocks[(bx, by)]
+
+    def resolve(self, edges, removals):
+        for edge in edges:
+            self.ambiguous.discard(cn_edge(edge))
+            self._curve_extents.pop(cn_edge(edge), None)
+            for node in edge[:2]:
+                self._link_cache.pop(node, None)
+            if edge in removals:
+                # Remove this edge
+                self.remove_edge(edge)
+            else:
+                # Clean up other edges
+                edge[2].pop('h_weight', None)
 
     def weight_diagonals(self, edge1, edge2):
         """
@@ -218,6 +703,25 @@ class IterativeFinalShapeHeuristics(DiagonalResolutionHeuristics):
         # We have an ambiguous result.
         return None
 
+    def fallback_margin(self, edge1, edge2):
+        """
+        How far apart the midpoints of the weight ranges of a pair are.
+        """
+        return abs(sum(edge1[2]['h_weight']) - sum(edge2[2]['h_weight']))
+
+    def fallback_removals(self, edge1, edge2):
+        """
+        Resolve a pair that is still ambiguous by comparing the midpoints of
+        the weight ranges, removing both if they are equal.
+        """
+        mid1 = sum(edge1[2]['h_weight'])
+        mid2 = sum(edge2[2]['h_weight'])
+        if mid1 == mid2:
+            return (edge1, edge2)
+        if mid1 > mid2:
+            return (edge2,)
+        return (edge1,)
+
     def weight_diagonal(self, edge):
         """
         Apply heuristics to an ambiguous diagonal.
@@ -229,38 +733,86 @@ class IterativeFinalShapeHeuristics(DiagonalResolutionHeuristics):
             ]
         edge[2]['h_weight'] = tuple(sum(w) for w in zip(*weights))
 
+    def _links(self, node, examined):
+        """
+        Split a node's neighbours into those it will definitely keep and
+        those it might keep if the examined edge is kept.
+
+        That means the other diagonal in its block must be removed, which
+        only matters to the nodes in that block. Everything else gets the
+        same answer whichever edge we're examining, so we keep it until
+        something changes in the node's own block.
+        """
+        (x0, y0), (x1, y1) = examined
+        if node in examined or node == (x0, y1) or node == (x1, y0):
+            return self._find_links(node, examined)
+        links = self._link_cache.get(node)
+        if links is None:
+            links = self._link_cache[node] = self._find_links(node, None)
+        return links
+
+    def _find_links(self, node, examined):
+        certain = []
+        possible = []
+        for neighbor in self.pixel_graph.neighbors(node):
+            edge = cn_edge((node, neighbor))
+            if edge == examined or edge not in self.ambiguous:
+                certain.append(neighbor)
+                possible.append(neighbor)
+            elif examined is None or not self._crosses(edge, examined):
+                possible.append(neighbor)
+        return certain, possible
+
+    def _crosses(self, edge, examined):
+        (x0, y0), (x1, y1) = edge
+        (ex0, ey0), (ex1, ey1) = examined
+        return (min(x0, x1) == min(ex0, ex1) and min(y0, y1) == min(ey0, ey1)
+                and edge != examined)
+
+    def _degree_range(self, node, examined):
+        certain, possible = self._links(node, examined)
+        return (len(certain), len(possible))
+
     def weight_curve(self, edge):
         """
         Weight diagonals based on curve length.
 
         Edges that are part of long single-pixel-wide features are
         more likely to be important.
-        """
-        seen_edges = set([cn_edge(edge)])
-        nodes = list(edge[:2])
 
-        values = list(self._weight_curve(nodes, seen_edges))
-        retvals = (min(values), max(values))
-        return retvals
-
-    def _weight_curve(self, nodes, seen_edges):
-        while nodes:
+        The shortest the curve could be only follows nodes that will
+        definitely have valence 2. The longest it could be follows every node
+        that might end up with valence 2. Both stop at `MAX_CURVE_LENGTH`.
+        """
+        examined = cn_edge(edge)
+        shortest = self._walk_curve(examined, certain_only=True)
+        longest = self._walk_curve(examined, certain_only=False)
+        self._curve_extents[examined] = longest
+        return (min(len(shortest), self.MAX_CURVE_LENGTH),
+                min(len(longest), self.MAX_CURVE_LENGTH))
+
+    def _walk_curve(self, examined, certain_only):
+        seen_edges = set([examined])
+        nodes = list(examined)
+
+        while nodes and len(seen_edges) < self.MAX_CURVE_LENGTH:
             node = nodes.pop()
-            edges = self.pixel_graph.edges(node, data=True)
-            if len(edges) != 2:
-                # This node is not part of a curve
-                continue
-            for edge in edges:
-                ambiguous = ('ambiguous' in edge[2])
-                edge = cn_edge(edge)
+            certain, possible = self._links(node, examined)
+            if certain_only:
+                if len(certain) != 2 or len(possible) != 2:
+                    continue
+                neighbors = certain
+            else:
+                if not (len(certain) <= 2 <= len(possible)):
+                    # This node is not part of a curve
+                    continue
+                neighbors = possible
+            for neighbor in neighbors:
+                edge = cn_edge((node, neighbor))
                 if edge not in seen_edges:
                     seen_edges.add(edge)
-                    if ambiguous:
-                        for v in self._weight_curve(
-                                nodes[:], seen_edges.copy()):
-                            yield v
-                    nodes.extend(n for n in edge if n != node)
-        yield len(seen_edges)
+                    nodes.append(neighbor)
+        return seen_edges
 
     def weight_sparse(self, edge):
         """
@@ -269,30 +821,33 @@ class IterativeFinalShapeHeuristics(DiagonalResolutionHeuristics):
         Sparse features are more likely to be seen as "foreground"
         rather than "background", and are therefore likely to be more
         important.
+
+        The smallest the feature could be only follows edges that will
+        definitely be kept, and the largest follows all of them.
         """
-        offset = self.sparse_window_offset(edge)
-        nodes = list(edge[:2])
+        examined = cn_edge(edge)
+        smallest = self._flood_window(examined, certain_only=True)
+        largest = self._flood_window(examined, certain_only=False)
+        return (-largest, -smallest)
+
+    def _flood_window(self, examined, certain_only):
+        min_x, min_y = self.sparse_windows.window_origin(examined)
+        max_x = min_x + self.SPARSE_WINDOW_SIZE[0]
+        max_y = min_y + self.SPARSE_WINDOW_SIZE[1]
+        nodes = list(examined)
         seen_nodes = set(nodes)
 
-        values = list(self._weight_sparse(offset, nodes, seen_nodes))
-        retvals = (min(values), max(values))
-        return retvals
-
-    def _weight_sparse(self, offset, nodes, seen_nodes):
         while nodes:
             node = nodes.pop()
-            for n in self.pixel_graph.neighbors(node):
+            certain, possible = self._links(node, examined)
+            for n in (certain if certain_only else possible):
                 if n in seen_nodes:
                     continue
-                if 'ambiguous' in self.pixel_graph[node][n]:
-                    for v in self._weight_sparse(
-                            offset, nodes[:], seen_nodes.copy()):
-                        yield v
-                if within_bounds(n, self.SPARSE_WINDOW_SIZE, offset):
+                if min_x <= n[0] < max_x and min_y <= n[1] < max_y:
                     seen_nodes.add(n)
                     nodes.append(n)
 
-        yield -len(seen_nodes)
+        return len(seen_nodes)
 
     def weight_island(self, edge):
         """
@@ -301,9 +856,13 @@ class IterativeFinalShapeHeuristics(DiagonalResolutionHeuristics):
         Single pixels connected to nothing except the edge being
         examined are likely to be more important.
         """
-        if (len(self.pixel_graph[edge[0]]) == 1
-            or len(self.pixel_graph[edge[1]]) == 1):
+        examined = cn_edge(edge)
+        degree_ranges = [self._degree_range(node, examined)
+                         for node in examined]
+        if any(max_degree == 1 for _, max_degree in degree_ranges):
             return (5, 5)
+        if any(min_degree == 1 for min_degree, _ in degree_ranges):
+            return (0, 5)
         return (0, 0)
 
 
@@ -312,16 +871,56 @@ class PixelData(object):
     A representation of a pixel image that knows how to depixel it.
 
     :param data: A 2d array of pixel values. It is assumed to be rectangular.
+    :param palette: If provided, the pixel values are indexes into this list
+        of colours. The depixeling only ever compares pixel values, so small
+        integers are both cheaper to store and faster to compare than colour
+        tuples. See `depixel.io_data.index_pixels`.
     """
 
     HEURISTICS = FullyConnectedHeuristics
     # HEURISTICS = IterativeFinalShapeHeuristics
 
-    def __init__(self, pixels):
+    PIXEL_GRAPH_ENGINE = 'networkx'
+    # PIXEL_GRAPH_ENGINE = 'array'
+
+    # YUV thresholds for similarity matching, or None for exact matching.
+    SIMILARITY = None
+    # SIMILARITY = YUV_THRESHOLDS
+
+    SPLINE_SMOOTHER = bspline.SplineSmoother
+    # SPLINE_SMOOTHER = bspline.GradientSplineSmoother
+
+    # Shapes of this colour are never drawn, so we don't spend any effort on
+    # outlines that only they need. BACKGROUND_FROM_BORDER picks the most
+    # common colour around the edge of the image, and None draws everything.
+    BACKGROUND = (255, 255, 255)
+    # BACKGROUND = BACKGROUND_FROM_BORDER
+    # BACKGROUND = None
+
+    # Number of processes to smooth splines in, or 0 for one per CPU.
+    JOBS = 1
+    # JOBS = 0
+
+    def __init__(self, pixels, palette=None, pixel_graph_engine=None,
+                 similarity=None, background=None, jobs=None):
         self.pixels = pixels
+        self.palette = palette
         self.size_x = len(pixels[0])
         self.size_y = len(pixels)
         self.size = (self.size_x, self.size_y)
+        if pixel_graph_engine is not None:
+            self.PIXEL_GRAPH_ENGINE = pixel_graph_engine
+        if similarity is True:
+            similarity = YUV_THRESHOLDS
+        if similarity is not None:
+            self.SIMILARITY = similarity
+        if background is False:
+            background = None
+        elif background is None:
+            background = self.BACKGROUND
+        self.BACKGROUND = background
+        if jobs is not None:
+            self.JOBS = jobs
 
     def depixel(self):
         """
@@ -331,10 +930,8 @@ class PixelData(object):
         """
         self.make_pixel_graph()
         self.remove_diagonals()
-        self.make_grid_graph()
         self.deform_grid()
         self.make_shapes()
-        self.isolate_outlines()
         self.add_shape_outlines()
         self.smooth_splines()
 
@@ -344,45 +941,118 @@ class PixelData(object):
         """
         return self.pixels[y][x]
 
+    def colour(self, value):
+        """
+        Get the colour for a pixel value, looking it up in the palette if we
+        have one.
+        """
+        if self.palette is None:
+            return value
+        return self.palette[value]
+
+    def find_background(self):
+        """
+        Get the background colour, or None if we don't have one.
+        """
+        if self.BACKGROUND != BACKGROUND_FROM_BORDER:
+            return self.BACKGROUND
+        border = chain(
+            self.pixels[0], self.pixels[-1],
+            (row[0] for row in self.pixels[1:-1]),
+            (row[-1] for row in self.pixels[1:-1]))
+        counts = {}
+        for value in border:
+            counts[value] = counts.get(value, 0) + 1
+        # Ties go to whichever value we saw first.
+        value = max(counts, key=counts.get)
+        return self.colour(value)
+
     def make_grid_graph(self):
         """
-        Build a graph representing the pixel grid.
+        Build a mesh representing the undeformed pixel grid.
+
+        `deform_grid` builds its own mesh, so this is only needed if we want
+        to look at the grid before it's deformed.
+        """
+        self.mesh = self._make_mesh({})
+
+    @property
+    def grid_graph(self):
+        """
+        The edges of the mesh as a `networkx` graph.
         """
-        self.grid_graph = nx.grid_2d_graph(self.size_x + 1, self.size_y + 1)
+        grid_graph = nx.Graph()
+        grid_graph.add_edges_from(self.mesh.edges())
+        return grid_graph
 
     def make_pixel_graph(self):
         """
         Build a graph representing the pixel data.
+
+        The 'networkx' engine builds a general-purpose graph one pixel at a
+        time using `match`. The 'array' engine builds a much more compact
+        `PixelGraph` for the whole image at once from `match_masks`.
         """
+        if self.PIXEL_GRAPH_ENGINE == 'networkx':
+            self._make_networkx_pixel_graph()
+        elif self.PIXEL_GRAPH_ENGINE == 'array':
+            self.pixel_graph = PixelGraph(
+                self.pixels, build_links(self.size, self.match_masks()))
+        else:
+            raise ValueError(
+                "Unknown pixel graph engine: %r" % (self.PIXEL_GRAPH_ENGINE,))
+
+    def _make_networkx_pixel_graph(self):
         self.pixel_graph = nx.Graph()
 
         for x, y in gen_coords(self.size):
-            # While the nodes are created by adding edges, adding them
-            # again is safe and lets us easily update metadata.
-            corners = set([(x, y), (x + 1, y), (x, y + 1), (x + 1, y + 1)])
-            self.pixel_graph.add_node((x, y),
-                                      value=self.pixel(x, y), corners=corners)
-            # This gets called on each node, so we don't have to duplicate
-            # edges.
-            self._add_pixel_edge((x, y), (x + 1, y))
-            self._add_pixel_edge((x, y), (x, y + 1))
-            self._add_pixel_edge((x, y), (x + 1, y - 1))
-            self._add_pixel_edge((x, y), (x + 1, y + 1))
-
-    def _add_pixel_edge(self, pix0, pix1):
-        """
-        Add an edge to the pixel graph, checking bounds and tagging diagonals.
-        """
-        if within_bounds(pix1, self.size) and self.match(pix0, pix1):
-            attrs = {'diagonal': pix0[0] != pix1[0] and pix0[1] != pix1[1]}
-            self.pixel_graph.add_edge(pix0, pix1, **attrs)
+            self.pixel_graph.add_node((x, y), value=self.pixel(x, y),
+                                      corners=default_corners((x, y)))
+
+        for direction, rows in self.match_masks().items():
+            dx, dy = NEIGHBOURS[direction]
+            diagonal = dx != 0 and dy != 0
+            for y, row in enumerate(rows):
+                for x in compress(range(self.size_x), row):
+                    self.pixel_graph.add_edge(
+                        (x, y), (x + dx, y + dy), diagonal=diagonal)
 
     def match(self, pix0, pix1):
         """
-        Check if two pixels match. By default, this tests equality.
+        Check if two pixels match. By default, this tests equality, or YUV
+        similarity if `SIMILARITY` is set.
         """
+        if self.SIMILARITY is not None:
+            yuv0 = rgb_to_yuv(self.colour(self.pixel(*pix0)))
+            yuv1 = rgb_to_yuv(self.colour(self.pixel(*pix1)))
+            return all(abs(c0 - c1) <= threshold for c0, c1, threshold
+                       in zip(yuv0, yuv1, self.SIMILARITY))
         return self.pixel(*pix0) == self.pixel(*pix1)
 
+    def match_masks(self):
+        """
+        Match every pixel against its neighbours in one pass.
+
+        See `depixel.pixelgraph.match_masks` for the format. If `match` has
+        been overridden, we call it for each pair of neighbours. Otherwise we
+        compare pixel values (or their YUV components) a row at a time, which
+        is much faster.
+        """
+        if getattr(self, '_match_masks', None) is None:
+            if type(self).match is not PixelData.match:
+                coords = [[(x, y) for x in range(self.size_x)]
+                          for y in range(self.size_y)]
+                self._match_masks = dict(
+                    (direction, shifted_rows(coords, direction, self.match))
+                    for direction in FORWARD_DIRECTIONS)
+            elif self.SIMILARITY is not None:
+                self._match_masks = similarity_masks(
+                    self.pixels, self.SIMILARITY,
+                    lambda value: rgb_to_yuv(self.colour(value)))
+            else:
+                self._match_masks = match_masks(self.pixels)
+        return self._match_masks
+
     def remove_diagonals(self):
         """
         Remove all unnecessary diagonals and resolve checkerboard features.
@@ -392,206 +1062,383 @@ class PixelData(object):
         blocks (in which both diagonals can be removed) and checkerboard blocks
         (in which we need to apply heuristics to determine which diagonal to
         remove). See the paper for details.
+
+        The blocks are classified all at once from `match_masks`, so we only
+        touch the graph for blocks that actually have crossing diagonals.
         """
-        ambiguous_diagonal_pairs = []
+        full_blocks, ambiguous_blocks = classify_blocks(self.match_masks())
 
-        for nodes in self.walk_pixel_blocks(2):
-            edges = [e for e in self.pixel_graph.edges(nodes, data=True)
-                     if e[0] in nodes and e[1] in nodes]
-
-            diagonals = [e for e in edges if e[2]['diagonal']]
-            if len(diagonals) == 2:
-                if len(edges) == 6:
-                    # We have a fully-connected block, so remove all diagonals.
-                    for edge in diagonals:
-                        self.pixel_graph.remove_edge(edge[0], edge[1])
-                elif len(edges) == 2:
-                    # We have an ambiguous pair to resolve.
-                    ambiguous_diagonal_pairs.append(edges)
-                else:
-                    # If we get here, we have an invalid graph, possibly due to
-                    # a faulty match function.
-                    assert False, "Unexpected diagonal layout"
+        for block in full_blocks:
+            # We have a fully-connected block, so remove all diagonals.
+            for edge in block_diagonals(block):
+                self.pixel_graph.remove_edge(*edge)
+
+        ambiguous_diagonal_pairs = []
+        for block in ambiguous_blocks:
+            # We have an ambiguous pair to resolve.
+            ambiguous_diagonal_pairs.append([
+                (pix0, pix1, self.pixel_graph[pix0][pix1])
+                for pix0, pix1 in block_diagonals(block)])
 
         self.apply_diagonal_heuristics(ambiguous_diagonal_pairs)
 
     def apply_diagonal_heuristics(self, ambiguous_diagonal_pairs):
-        self.HEURISTICS(self.pixel_graph).apply(ambiguous_diagonal_pairs)
-
-    def walk_pixel_blocks(self, size):
-        """
-        Walk the pixel graph in block of NxN pixels.
-
-        This is useful for operating on a group of nodes at once.
-        """
-        for x, y in gen_coords((self.size_x - size + 1,
-                                self.size_y - size + 1)):
-            yield [(x + dx, y + dy)
-                   for dx in range(size) for dy in range(size)]
+        self.heuristics = self.HEURISTICS(self.pixel_graph)
+        self.heuristics.apply(ambiguous_diagonal_pairs)
 
     def deform_grid(self):
         """
         Deform the pixel grid based on the connections between similar pixels.
-        """
-        for node in self.pixel_graph.nodes_iter():
-            self.deform_pixel(node)
-
-        # Collapse all valence-2 nodes.
-        removals = []
-        for node in self.grid_graph.nodes_iter():
-            if node in ((0, 0), (0, self.size[1]),
-                        (self.size[0], 0), self.size):
-                # Skip corner nodes.
-                continue
-            neighbors = self.grid_graph.neighbors(node)
-            if len(neighbors) == 2:
-                self.grid_graph.add_edge(*neighbors)
-            if len(neighbors) <= 2:
-                removals.append(node)
 
-        # We can't do this above, because it would modify the dict
-        # we're iterating.
-        for node in removals:
-            self.grid_graph.remove_node(node)
+        The deformation around each lattice vertex only depends on the four
+        pixels around it, so we look it up in `VERTEX_PATTERNS` and build the
+        deformed mesh in one pass. Valence-2 vertices are then collapsed,
+        because they're just kinks in the middle of an edge.
+        """
+        self.mesh = self._make_mesh(self.vertex_patterns())
+        self.mesh.collapse_vertices(keep=[
+            (0, 0), (0, self.size_y * LATTICE_SCALE),
+            (self.size_x * LATTICE_SCALE, 0),
+            (self.size_x * LATTICE_SCALE, self.size_y * LATTICE_SCALE)])
 
         # Update pixel corner sets.
-        for node, attrs in self.pixel_graph.nodes_iter(data=True):
-            corners = attrs['corners']
-            for corner in corners.copy():
-                if corner not in self.grid_graph:
-                    corners.remove(corner)
+        if isinstance(self.pixel_graph, PixelGraph):
+            self.pixel_graph.set_corners(self.pixel_corners)
+        else:
+            for pixel, attrs in self.pixel_graph.nodes(data=True):
+                attrs['corners'] = self.pixel_corners(pixel)
 
-    def deform_pixel(self, node):
+    def pixel_corners(self, pixel):
         """
-        Deform an individual pixel.
+        Get the corners of a pixel in the deformed grid.
         """
-        for neighbor in self.pixel_graph.neighbors(node):
-            if node[0] == neighbor[0] or node[1] == neighbor[1]:
-                # We only care about diagonals.
-                continue
-            px_x = max(neighbor[0], node[0])
-            px_y = max(neighbor[1], node[1])
-            pixnode = (px_x, px_y)
-            offset_x = neighbor[0] - node[0]
-            offset_y = neighbor[1] - node[1]
-            # There's probably a better way to do this.
-            adj_node = (neighbor[0], node[1])
-            if not self.match(node, adj_node):
-                pn = (px_x, px_y - offset_y)
-                mpn = (px_x, px_y - 0.5 * offset_y)
-                npn = (px_x + 0.25 * offset_x, px_y - 0.25 * offset_y)
-                remove_from_set(self.pixel_corners(adj_node), pixnode)
-                self.pixel_corners(adj_node).add(npn)
-                self.pixel_corners(node).add(npn)
-                self._deform(pixnode, pn, mpn, npn)
-            adj_node = (node[0], neighbor[1])
-            if not self.match(node, adj_node):
-                pn = (px_x - offset_x, px_y)
-                mpn = (px_x - 0.5 * offset_x, px_y)
-                npn = (px_x - 0.25 * offset_x, px_y + 0.25 * offset_y)
-                remove_from_set(self.pixel_corners(adj_node), pixnode)
-                self.pixel_corners(adj_node).add(npn)
-                self.pixel_corners(node).add(npn)
-                self._deform(pixnode, pn, mpn, npn)
-
-    def pixel_corners(self, pixel):
-        return self.pixel_graph.node[pixel]['corners']
-
-    def _deform(self, pixnode, pn, mpn, npn):
-        # Do the node and edge shuffling.
-        if mpn in self.grid_graph:
-            self.grid_graph.remove_edge(mpn, pixnode)
-        else:
-            self.grid_graph.remove_edge(pn, pixnode)
-            self.grid_graph.add_edge(pn, mpn)
-        self.grid_graph.add_edge(mpn, npn)
-        self.grid_graph.add_edge(npn, pixnode)
+        return set(self.mesh.cell_boundary(pixel))
+
+    def _make_mesh(self, patterns):
+        mesh = HalfEdgeMesh()
+        for y in range(self.size_y):
+            for x in range(self.size_x):
+                boundary = []
+                for vertex, pixel in (((x, y), BR), ((x + 1, y), BL),
+                                      ((x + 1, y + 1), TL), ((x, y + 1), TR)):
+                    pattern = VERTEX_PATTERNS[patterns.get(vertex, 0)]
+                    vertex = (vertex[0] * LATTICE_SCALE,
+                              vertex[1] * LATTICE_SCALE)
+                    boundary.extend(offset_coord(vertex, offset)
+                                    for offset in pattern[pixel])
+                mesh.add_cell((x, y), boundary)
+        return mesh
+
+    def vertex_patterns(self):
+        """
+        Find the pattern index into `VERTEX_PATTERNS` for every interior
+        lattice vertex that isn't just a plain grid vertex.
+        """
+        masks = [[link_mask(self.pixel_graph, (x, y))
+                  for x in range(self.size_x)]
+                 for y in range(self.size_y)]
+        patterns = {}
+        for vy in range(1, self.size_y):
+            above, below = masks[vy - 1], masks[vy]
+            for vx in range(1, self.size_x):
+                tl, tr, bl = above[vx - 1], above[vx], below[vx - 1]
+                if tl >> SE & 1:
+                    diagonal = DIAGONAL_TL_BR
+                elif tr >> SW & 1:
+                    diagonal = DIAGONAL_TR_BL
+                else:
+                    continue
+                patterns[(vx, vy)] = diagonal << 4 | (
+                    (tl >> E & 1) << EDGE_N | (tr >> S & 1) << EDGE_E |
+                    (bl >> E & 1) << EDGE_S | (tl >> S & 1) << EDGE_W)
+        return patterns
 
     def make_shapes(self):
-        self.shapes = set()
+        """
+        Find the connected shapes in the pixel graph.
 
-        for pcg in nx.connected_component_subgraphs(self.pixel_graph):
-            pixels = set()
-            value = None
-            corners = set()
-            for pixel, attrs in pcg.nodes_iter(data=True):
-                pixels.add(pixel)
-                corners.update(attrs['corners'])
-                value = attrs['value']
-            self.shapes.add(Shape(pixels, value, corners))
+        The shapes are listed in the order their first pixels appear, counting
+        along each row in turn. Shapes in the background colour are flagged,
+        because they won't be drawn.
+        """
+        self.shape_labels = ShapeLabels(self.pixel_graph, self.size)
+        self.shapes = [Shape(self.shape_labels, label)
+                       for label in range(len(self.shape_labels))]
+        self.background = self.find_background()
+        if self.background is not None:
+            for shape in self.shapes:
+                shape.background = self.colour(shape.value) == self.background
 
     def isolate_outlines(self):
-        # Remove internal edges from a copy of our pixgrid graph.
-        self.outlines_graph = nx.Graph(self.grid_graph)
-        for pixel, attrs in self.pixel_graph.nodes_iter(data=True):
-            corners = attrs['corners']
-            for neighbor in self.pixel_graph.neighbors(pixel):
-                edge = corners & self.pixel_graph.node[neighbor]['corners']
-                if len(edge) != 2:
-                    print(edge)
-                if self.outlines_graph.has_edge(*edge):
-                    self.outlines_graph.remove_edge(*edge)
-        for node in nx.isolates(self.outlines_graph):
-            self.outlines_graph.remove_node(node)
-
-    def make_path(self, graph):
-        path = Path(graph)
-        key = path.key()
-        if key not in self.paths:
-            self.paths[key] = path
-            path.make_spline()
-        return self.paths[key]
+        """
+        Find the mesh edges that separate pixels in different shapes, or
+        pixels from the outside of the image.
+
+        `add_shape_outlines` finds its outlines in the mesh directly, so
+        `depixel` doesn't need this. It's only here for looking at.
+        """
+        self.outlines_graph = nx.Graph()
+        self.outlines_graph.add_edges_from(
+            (v0, v1) for v0, v1, pix0, pix1 in self.mesh.edges(cells=True)
+            if pix0 is None or pix1 is None
+            or not self.pixel_graph.has_edge(pix0, pix1))
 
     def add_shape_outlines(self):
+        """
+        Trace the boundary of every shape through the mesh and attach each
+        one to the shapes on both sides of it.
+
+        The outside boundary of a shape goes around it the same way as its
+        pixel cells, and the boundaries of any holes go the other way. Each
+        path is keyed by the smallest half-edge on its boundary, and a
+        boundary shared by two shapes is only turned into a path once.
+        Outlines of single pixels and rectangles get their splines from
+        `self.path_templates`, and boundaries that only background shapes
+        would need are skipped altogether.
+        """
         self.paths = {}
-
-        for shape in self.shapes:
-            sg = self.outlines_graph.subgraph(shape.corners)
-            for graph in nx.connected_component_subgraphs(sg):
-                path = self.make_path(graph)
-                if (min(graph.nodes()) == min(sg.nodes())):
-                    shape.add_outline(path, True)
+        self.path_templates = {}
+        labels = self.shape_labels.labels
+        mesh = self.mesh
+        outlines = []
+
+        def shape_label(pixel):
+            return labels[pixel[1]][pixel[0]]
+
+        for boundary, twin in mesh.boundaries(shape_label):
+            label = shape_label(mesh.cells[boundary[0]])
+            if twin is not None:
+                # Our twin goes around its own shape the other way.
+                path, twin_outside = outlines[twin]
+                outside = not twin_outside
+            elif self._only_background(boundary, label):
+                # Nothing that gets drawn needs this boundary.
+                path = outside = None
+            else:
+                vertices = [mesh.vertices[mesh.origins[half_edge]]
+                            for half_edge in boundary]
+                inside_label = self._trivial_shape_inside(boundary, label)
+                if inside_label is not None:
+                    path = TemplatePath(vertices, self.path_templates)
+                    outside = inside_label == label
                 else:
-                    shape.add_outline(path)
+                    path = Path(vertices)
+                    outside = signed_area(vertices) > 0
+                path.make_spline()
+                self.paths[min(boundary)] = path
+            outlines.append((path, outside))
+            if path is not None:
+                self.shapes[label].add_outline(path, outside)
+
+    def _only_background(self, boundary, label):
+        """
+        Check if this boundary is between background shapes and the outside
+        of the image.
+        """
+        shapes = self.shapes
+        if not shapes[label].background:
+            return False
+        labels = self.shape_labels.labels
+        cells = self.mesh.cells
+        for half_edge in boundary:
+            cell = cells[half_edge ^ 1]
+            if cell is None:
+                continue
+            if not shapes[labels[cell[1]][cell[0]]].background:
+                return False
+        return True
+
+    def _trivial_shape_inside(self, boundary, label):
+        """
+        Find the label of the shape this boundary goes around if it's a
+        single pixel or a rectangle, which only has the one boundary.
+        """
+        shape_labels = self.shape_labels
+        if shape_labels.is_rectangle(label):
+            return label
+        labels = shape_labels.labels
+        cells = self.mesh.cells
+        other_label = None
+        for half_edge in boundary:
+            cell = cells[half_edge ^ 1]
+            if cell is None:
+                return None
+            cell_label = labels[cell[1]][cell[0]]
+            if other_label is None:
+                if not shape_labels.is_rectangle(cell_label):
+                    return None
+                other_label = cell_label
+            elif cell_label != other_label:
+                return None
+        return other_label
 
     def smooth_splines(self):
         print("Smoothing splines...")
-        for i, path in enumerate(self.paths.values()):
-            print(" * %s/%s (%s, %s)..." % (
-                i + 1, len(self.paths), len(path.shapes), len(path.path)))
+        targets = set()
+        for path in self.paths.values():
             if len(path.shapes) == 1:
                 path.smooth = path.spline.copy()
                 continue
-            path.smooth_spline()
+            targets.add(path.smoothing_target())
+        # Every path has its own seed, so we get the same answer however
+        # many processes we use. The longest paths take longest, so we start
+        # them first.
+        targets = sorted(targets, key=lambda target: (
+            -len(target.path), target.key()))
+        jobs = [(self.SPLINE_SMOOTHER, target.spline, target.seed())
+                for target in targets]
+
+        pool = None
+        results = map(smooth_spline_job, jobs)
+        if self.JOBS != 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(self.JOBS or None)
+            results = pool.imap(smooth_spline_job, jobs)
+        totals = {}
+        try:
+            for i, (target, (smooth, stats)) in enumerate(
+                    zip(targets, results)):
+                print(" * %s/%s (%s)..." % (
+                    i + 1, len(targets), len(target.path)))
+                target.smooth = smooth
+                target.smooth_stats = stats
+                for name, value in stats.items():
+                    totals[name] = totals.get(name, 0) + value
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Copies of templates just need moving into place.
+        for path in self.paths.values():
+            if not hasattr(path, 'smooth'):
+                path.smooth_spline(self.SPLINE_SMOOTHER)
+        print("Smoothing stats: %s" % (", ".join(
+            "%s=%s" % item for item in sorted(totals.items())),))
+
+
+class ShapeLabels(object):
+    """
+    The connected shapes in a pixel graph, as a label image.
+
+    `labels` has one row of shape labels for each row of pixels, and the
+    pixel count, bounding box and pixel value of each shape are indexed by
+    its label. Bounding boxes are `(min_x, min_y, max_x, max_y)`, inclusive.
+    With similarity matching, the value is that of the first pixel in the
+    shape.
+    """
+
+    def __init__(self, pixel_graph, size):
+        self.pixel_graph = pixel_graph
+        size_x, size_y = size
+        if isinstance(pixel_graph, PixelGraph):
+            links = pixel_graph.links
+        else:
+            links = bytearray(
+                link_mask(pixel_graph, node) for node in gen_coords(size))
+        labels, num_labels = label_components(size, links)
+        self.labels = [labels[y * size_x:(y + 1) * size_x]
+                       for y in range(size_y)]
+
+        self.counts = [0] * num_labels
+        self.values = [None] * num_labels
+        bboxes = [None] * num_labels
+        for y, row in enumerate(self.labels):
+            for x, label in enumerate(row):
+                if self.counts[label] == 0:
+                    self.values[label] = pixel_graph.nodes[(x, y)]['value']
+                    bboxes[label] = [x, y, x, y]
+                else:
+                    bbox = bboxes[label]
+                    if x < bbox[0]:
+                        bbox[0] = x
+                    elif x > bbox[2]:
+                        bbox[2] = x
+                    bbox[3] = y
+                self.counts[label] += 1
+        self.bboxes = [tuple(bbox) for bbox in bboxes]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def is_rectangle(self, label):
+        min_x, min_y, max_x, max_y = self.bboxes[label]
+        return self.counts[label] == (max_x - min_x + 1) * (max_y - min_y + 1)
+
+    def pixels(self, label):
+        min_x, min_y, max_x, max_y = self.bboxes[label]
+        pixels = set()
+        for y in range(min_y, max_y + 1):
+            row = self.labels[y]
+            pixels.update((x, y) for x in range(min_x, max_x + 1)
+                          if row[x] == label)
+        return pixels
+
+    def corners(self, label):
+        corners = set()
+        for pixel in self.pixels(label):
+            corners.update(self.pixel_graph.nodes[pixel]['corners'])
+        return corners
 
 
 class Shape(object):
-    def __init__(self, pixels, value, corners):
-        self.pixels = pixels
-        self.value = value
-        self.corners = corners
+    """
+    A connected shape of pixels.
+
+    Its pixels and corners are only collected from the `ShapeLabels` when
+    they're first needed, so we don't pay for them on shapes nobody looks at.
+
+    A background shape that reaches the edge of the image has no outside
+    path, because we never make outlines that only background shapes need,
+    so its paths and splines are just the inside ones.
+    """
+
+    def __init__(self, shape_labels, label):
+        self.shape_labels = shape_labels
+        self.label = label
+        self.value = shape_labels.values[label]
+        self._pixels = None
+        self._corners = None
+        self.background = False
         self._outside_path = None
         self._inside_paths = []
 
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            self._pixels = self.shape_labels.pixels(self.label)
+        return self._pixels
+
+    @property
+    def corners(self):
+        if self._corners is None:
+            self._corners = self.shape_labels.corners(self.label)
+        return self._corners
+
     def _paths_attr(self, attr):
         paths = [list(reversed(getattr(self._outside_path, attr)))]
         paths.extend(getattr(path, attr) for path in self._inside_paths)
 
     @property
     def paths(self):
-        paths = [list(reversed(self._outside_path.path))]
-        paths.extend(path.path for path in self._inside_paths)
+        paths = []
+        if self._outside_path is not None:
+            paths.append(list(reversed(self._outside_path.points)))
+        paths.extend(path.points for path in self._inside_paths)
         return paths
 
     @property
     def splines(self):
-        paths = [self._outside_path.spline.reversed()]
+        paths = []
+        if self._outside_path is not None:
+            paths.append(self._outside_path.spline.reversed())
         paths.extend(path.spline for path in self._inside_paths)
         return paths
 
     @property
     def smooth_splines(self):
-        paths = [self._outside_path.smooth.reversed()]
+        paths = []
+        if self._outside_path is not None:
+            paths.append(self._outside_path.smooth.reversed())
         paths.extend(path.smooth for path in self._inside_paths)
         return paths
 
@@ -604,33 +1451,96 @@ class Shape(object):
 
 
 class Path(object):
-    def __init__(self, shape_graph):
-        self.path = self._make_path(shape_graph)
+    # Corners between straight runs at least this many lattice units long
+    # stay sharp, or None to round them all off.
+    CORNER_LENGTH = 2 * LATTICE_SCALE
+    # CORNER_LENGTH = None
+
+    def __init__(self, vertices):
+        self.path = self._make_path(vertices)
         self.shapes = set()
 
     def key(self):
         return tuple(self.path)
 
-    def _make_path(self, shape_graph):
-        # Find initial nodes.
-        nodes = set(shape_graph.nodes())
-        path = [min(nodes)]
-        neighbors = sorted(shape_graph.neighbors(path[0]),
-                           key=lambda p: gradient(path[0], p))
-        path.append(neighbors[0])
-        nodes.difference_update(path)
+    def seed(self):
+        """
+        A random seed for smoothing that only depends on the path.
+        """
+        return zlib.crc32(repr(self.key()).encode('ascii'))
 
-        # Walk rest of nodes.
-        while nodes:
-            for neighbor in shape_graph.neighbors(path[-1]):
-                if neighbor in nodes:
-                    nodes.remove(neighbor)
-                    path.append(neighbor)
-                    break
-        return path
+    def smoothing_target(self):
+        """
+        The path whose spline needs smoothing to smooth this one.
+        """
+        return self
+
+    def _make_path(self, vertices):
+        # The same boundary traced from either side has its vertices in
+        # opposite orders, so we start at the smallest vertex and head for
+        # whichever neighbour has the smallest gradient.
+        count = len(vertices)
+        start_vertex = min(vertices)
+        best = None
+        for i, vertex in enumerate(vertices):
+            if vertex != start_vertex:
+                continue
+            for step in (1, -1):
+                grad = gradient(vertex, vertices[(i + step) % count])
+                if best is None or grad < best[0]:
+                    best = (grad, i, step)
+        _, start, step = best
+        return [vertices[(start + step * i) % count] for i in range(count)]
+
+    @property
+    def points(self):
+        return [lattice_point(vertex) for vertex in self.path]
 
     def make_spline(self):
-        self.spline = bspline.polyline_to_closed_bspline(self.path)
+        vertices = control_vertices(self.path, self.CORNER_LENGTH)
+        self.spline = bspline.polyline_to_closed_bspline(
+            [lattice_point(vertex) for vertex in vertices])
+
+    def smooth_spline(self, smoother=bspline.SplineSmoother):
+        self.smooth, self.smooth_stats = smooth_spline_job(
+            (smoother, self.spline, self.seed()))
+
 
-    def smooth_spline(self):
-        self.smooth = bspline.smooth_spline(self.spline)
+class TemplatePath(Path):
+    """
+    The outline of a single pixel or a rectangular shape.
+
+    There are only a few different outlines these shapes can have, apart
+    from where they are, so we make and smooth one template spline for each
+    of them and move copies of it into place.
+    """
+
+    def __init__(self, vertices, templates):
+        super(TemplatePath, self).__init__(vertices)
+        x0, y0 = self.path[0]
+        self.template_key = tuple((x - x0, y - y0) for x, y in self.path)
+        self.offset = lattice_point((x0, y0))
+        self.templates = templates
+
+    def _template(self):
+        template = self.templates.get(self.template_key)
+        if template is None:
+            template = Path(list(self.template_key))
+            template.make_spline()
+            self.templates[self.template_key] = template
+        return template
+
+    def smoothing_target(self):
+        return self._template()
+
+    def make_spline(self):
+        self.spline = self._template().spline.translated(self.offset)
+
+    def smooth_spline(self, smoother=bspline.SplineSmoother):
+        template = self._template()
+        # Only the first copy of a template does any smoothing.
+        self.smooth_stats = None
+        if not hasattr(template, 'smooth'):
+            template.smooth_spline(smoother)
+            self.smooth_stats = template.smooth_stats
+        self.smooth = template.smooth.translated(self.offset)
@@ -3,8 +3,11 @@ Unified I/O module for reading and writing various formats.
 """
 
 import os.path
+from array import array
 from itertools import product
 
+from depixel.mesh import lattice_point
+
 
 def gradient(p0, p1):
     dx = p1[0] - p0[0]
@@ -32,12 +35,16 @@ class PixelDataWriter(object):
         return tuple(int((n + o) * self.PIXEL_SCALE)
                      for n, o in zip(pt, offset))
 
+    def colour(self, value):
+        return self.pixel_data.colour(value)
+
     def export_pixels(self, outdir):
         filename = self.mkfn(outdir, 'pixels')
         drawing = self.make_drawing('pixels', filename)
         for pt in product(range(self.pixel_data.size_x),
                           range(self.pixel_data.size_y)):
-            self.draw_pixel(drawing, pt, self.pixel_data.pixel(*pt))
+            value = self.pixel_data.pixel(*pt)
+            self.draw_pixel(drawing, pt, self.colour(value))
         self.save_drawing(drawing, filename)
 
     def export_grid(self, outdir, node_graph=True):
@@ -65,26 +72,22 @@ class PixelDataWriter(object):
         self.save_drawing(drawing, filename)
 
     def draw_pixgrid(self, drawing):
-        for pixel, attrs in self.pixel_data.pixel_graph.nodes_iter(data=True):
-            nodes = attrs['corners'].copy()
-            path = [nodes.pop()]
-            while nodes:
-                for neighbor in self.pixel_data.grid_graph.neighbors(path[-1]):
-                    if neighbor in nodes:
-                        nodes.remove(neighbor)
-                        path.append(neighbor)
-                        break
-            self.draw_polygon(drawing, [self.scale_pt(p) for p in path],
-                              self.GRID_COLOUR, attrs['value'])
+        for pixel, attrs in self.pixel_data.pixel_graph.nodes(data=True):
+            path = self.pixel_data.mesh.cell_boundary(pixel)
+            self.draw_polygon(drawing,
+                              [self.scale_pt(lattice_point(p)) for p in path],
+                              self.GRID_COLOUR, self.colour(attrs['value']))
 
     def draw_shapes(self, drawing, element='smooth_splines'):
         for shape in self.pixel_data.shapes:
+            if shape.background:
+                continue
             paths = getattr(shape, element)
             self.draw_spline_shape(
-                drawing, paths, self.GRID_COLOUR, shape.value)
+                drawing, paths, self.GRID_COLOUR, self.colour(shape.value))
 
     def draw_nodes(self, drawing):
-        for edge in self.pixel_data.pixel_graph.edges_iter():
+        for edge in self.pixel_data.pixel_graph.edges():
             self.draw_line(drawing,
                            self.scale_pt(edge[0], (0.5, 0.5)),
                            self.scale_pt(edge[1], (0.5, 0.5)),
@@ -98,7 +101,7 @@ class PixelDataWriter(object):
             (0, 0, 0): (0, 191, 0),
             (127, 127, 127): (191, 0, 0),
             (255, 255, 255): (0, 0, 255),
-            }[self.pixel_data.pixel_graph.node[node]['value']]
+            }[self.colour(self.pixel_data.pixel_graph.nodes[node]['value'])]
 
     def mkfn(self, outdir, drawing_type):
         return os.path.join(
@@ -140,6 +143,24 @@ def get_writer(data, basename, filetype):
         "I don't recognise '%s' as a file type." % (filetype,))
 
 
+def index_pixels(pixels):
+    """
+    Convert pixel data to indexes into a palette of distinct pixel values.
+
+    Returns the indexed pixel data and the palette. Each row of indexed data
+    is an array of the smallest integer type that can hold all the indexes,
+    which is a single byte for anything with no more than 256 colours.
+    """
+    indexes = {}
+    rows = [[indexes.setdefault(value, len(indexes)) for value in row]
+            for row in pixels]
+    palette = sorted(indexes, key=indexes.get)
+    for typecode in ('B', 'H', 'L'):
+        if len(palette) <= 1 << (8 * array(typecode).itemsize):
+            break
+    return [array(typecode, row) for row in rows], palette
+
+
 def read_pixels(filename, filetype=None):
     if filetype is None:
         filetype = os.path.splitext(filename)[-1].lstrip('.')
@@ -147,3 +168,7 @@ def read_pixels(filename, filetype=None):
     if filetype == 'png':
         from depixel.io_png import read_png
         return read_png(filename)
+
+
+def read_indexed_pixels(filename, filetype=None):
+    return index_pixels(read_pixels(filename, filetype))
@@ -165,8 +165,8 @@ class PixelDataPngWriter(PixelDataWriter):
         drawing.fill(self.find_point_within(paths, fill), fill)
 
     def find_point_within(self, paths, colour):
-        for node, attrs in self.pixel_data.pixel_graph.nodes_iter(data=True):
-            if colour == attrs['value']:
+        for node, attrs in self.pixel_data.pixel_graph.nodes(data=True):
+            if colour == self.colour(attrs['value']):
                 pt = self.scale_pt(node, (0.5, 0.5))
                 if self.is_inside(pt, paths):
                     return pt
@@ -195,10 +195,12 @@ class PixelDataPngWriter(PixelDataWriter):
 
     def draw_shapes(self, drawing, element=None):
         for shape in self.pixel_data.shapes:
+            if shape.background:
+                continue
             paths = [[self.scale_pt(p) for p in path]
-                     for path in shape['paths']]
+                     for path in shape.paths]
             self.draw_path_shape(
-                drawing, paths, self.GRID_COLOUR, shape['value'])
+                drawing, paths, self.GRID_COLOUR, self.colour(shape.value))
 
 
 def read_png(filename):
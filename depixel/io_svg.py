@@ -39,9 +39,6 @@ class PixelDataSvgWriter(PixelDataWriter):
         drawing.add(drawing.path(dpath, stroke=rgb(colour), fill=rgb(fill)))
 
     def draw_spline_shape(self, drawing, splines, colour, fill):
-        if fill == (255, 255, 255):
-            # Don't draw plain white shapes.
-            return
         dpath = []
         for spline in splines:
             bcurves = list(spline.quadratic_bezier_segments())
@@ -0,0 +1,241 @@
+# -*- test-case-name: depixel.tests.test_mesh -*-
+
+"""
+A compact half-edge mesh for the cells of a (possibly deformed) pixel grid.
+
+Each cell is a pixel, bounded by a closed loop of vertices. Every edge is
+stored as a pair of half-edges running in opposite directions, and each
+half-edge knows the cell on its side of the edge. That means every edge knows
+the two pixels it separates, so finding outlines is just a matter of picking
+the right edges.
+
+Half-edges are numbered so that the twin of half-edge `h` is `h ^ 1` and they
+both belong to edge `h >> 1`. Everything else is stored in flat arrays indexed
+by half-edge.
+
+Vertices live on an integer lattice at `LATTICE_SCALE` times the resolution of
+the pixel grid, which is fine enough for every vertex the grid deformation can
+produce. Integer coordinates hash quickly and compare exactly, so we only
+convert them to real positions when we need to draw something or fit a spline
+to it.
+"""
+
+from array import array
+
+
+NO_HALF_EDGE = -1
+
+LATTICE_SCALE = 4
+
+
+def lattice_vertex(point):
+    """
+    Convert a point on the pixel grid to lattice coordinates.
+    """
+    return (int(point[0] * LATTICE_SCALE), int(point[1] * LATTICE_SCALE))
+
+
+def lattice_point(vertex):
+    """
+    Convert lattice coordinates to a point on the pixel grid.
+    """
+    return (float(vertex[0]) / LATTICE_SCALE, float(vertex[1]) / LATTICE_SCALE)
+
+
+class HalfEdgeMesh(object):
+    """
+    A half-edge mesh of pixel cells.
+
+    Cells are added one at a time with their boundaries in order, and
+    neighbouring cells must all go around their boundaries the same way. Any
+    half-edge that isn't on the boundary of a cell has a cell of `None`,
+    which is the outside of the image.
+    """
+
+    def __init__(self):
+        self.vertices = []
+        self._vertex_ids = {}
+        self.origins = array('l')
+        self.next = array('l')
+        self.prev = array('l')
+        self.cells = []
+        self._half_edges = {}
+        self._cell_half_edges = {}
+
+    def vertex_id(self, vertex):
+        vertex_id = self._vertex_ids.get(vertex)
+        if vertex_id is None:
+            vertex_id = self._vertex_ids[vertex] = len(self.vertices)
+            self.vertices.append(vertex)
+        return vertex_id
+
+    def add_cell(self, cell, boundary):
+        """
+        Add a cell with the given boundary vertices, in order.
+        """
+        vertex_id = self.vertex_id
+        vertex_ids = [vertex_id(vertex) for vertex in boundary]
+        find_half_edge = self._half_edges.get
+        origins = self.origins
+        cells = self.cells
+        half_edges = []
+        for origin, destination in zip(
+                vertex_ids, vertex_ids[1:] + vertex_ids[:1]):
+            half_edge = find_half_edge((origin, destination))
+            if half_edge is None:
+                half_edge = self._add_edge(origin, destination)
+            elif cells[half_edge] is not None:
+                raise ValueError(
+                    "Edge %s-%s already has a cell on this side." % (
+                        self.vertices[origin], self.vertices[destination]))
+            cells[half_edge] = cell
+            half_edges.append(half_edge)
+        for half_edge, next_half_edge in zip(
+                half_edges, half_edges[1:] + half_edges[:1]):
+            self.next[half_edge] = next_half_edge
+            self.prev[next_half_edge] = half_edge
+        self._cell_half_edges[cell] = half_edges[0]
+
+    def _add_edge(self, origin, destination):
+        half_edge = len(self.origins)
+        self.origins.extend((origin, destination))
+        self.next.extend((NO_HALF_EDGE, NO_HALF_EDGE))
+        self.prev.extend((NO_HALF_EDGE, NO_HALF_EDGE))
+        self.cells.extend((None, None))
+        self._half_edges[(origin, destination)] = half_edge
+        self._half_edges[(destination, origin)] = half_edge ^ 1
+        return half_edge
+
+    def cell_boundary(self, cell):
+        """
+        Get the vertices around a cell, in order.
+        """
+        start = half_edge = self._cell_half_edges[cell]
+        vertices = []
+        while True:
+            vertices.append(self.vertices[self.origins[half_edge]])
+            half_edge = self.next[half_edge]
+            if half_edge == start:
+                return vertices
+
+    def edges(self, cells=False):
+        """
+        Generate the edges as pairs of vertices, optionally followed by the
+        cells on either side.
+        """
+        vertices = self.vertices
+        origins = self.origins
+        for half_edge in range(0, len(origins), 2):
+            origin = origins[half_edge]
+            if origin == NO_HALF_EDGE:
+                # This edge has been collapsed away.
+                continue
+            edge = (vertices[origin], vertices[origins[half_edge + 1]])
+            if cells:
+                edge += (self.cells[half_edge], self.cells[half_edge + 1])
+            yield edge
+
+    def boundaries(self, region):
+        """
+        Generate the closed boundaries between regions of cells.
+
+        `region` maps each cell to the region it belongs to, and the outside
+        of the mesh isn't in any region. Each boundary goes around its region
+        the same way as the cells inside it do, so every half-edge on a
+        boundary is visited exactly once.
+
+        Boundaries are numbered in the order they're generated, and we
+        generate `(boundary, twin)` pairs where `boundary` is a list of
+        half-edges and `twin` is the number of an earlier boundary that runs
+        along exactly the same edges in the other direction, or `None` if
+        there isn't one.
+        """
+        origins = self.origins
+        next_half_edge = self.next
+        regions = [None if cell is None else region(cell)
+                   for cell in self.cells]
+        boundary_ids = array('l', [NO_HALF_EDGE]) * len(origins)
+        boundary_lengths = []
+        for start, start_region in enumerate(regions):
+            if (start_region is None or boundary_ids[start] != NO_HALF_EDGE
+                    or origins[start] == NO_HALF_EDGE
+                    or regions[start ^ 1] == start_region):
+                continue
+            boundary_id = len(boundary_lengths)
+            boundary = []
+            half_edge = start
+            while True:
+                boundary_ids[half_edge] = boundary_id
+                boundary.append(half_edge)
+                # Turn around the end of this half-edge, through any cells in
+                # the same region, until we find the next boundary half-edge.
+                half_edge = next_half_edge[half_edge]
+                while regions[half_edge ^ 1] == start_region:
+                    half_edge = next_half_edge[half_edge ^ 1]
+                if half_edge == start:
+                    break
+            boundary_lengths.append(len(boundary))
+
+            twin = boundary_ids[start ^ 1]
+            if (twin == NO_HALF_EDGE
+                    or boundary_lengths[twin] != len(boundary)
+                    or any(boundary_ids[half_edge ^ 1] != twin
+                           for half_edge in boundary)):
+                twin = None
+            yield boundary, twin
+
+    def _outgoing(self):
+        outgoing = {}
+        for half_edge, origin in enumerate(self.origins):
+            if origin != NO_HALF_EDGE:
+                outgoing.setdefault(origin, []).append(half_edge)
+        return outgoing
+
+    def collapse_vertices(self, keep=()):
+        """
+        Remove every vertex with only two edges, other than those in `keep`,
+        by merging its edges. Such vertices are just kinks in the middle of
+        an edge.
+        """
+        keep = set(self._vertex_ids[v] for v in keep if v in self._vertex_ids)
+        outgoing = self._outgoing()
+        for vertex in range(len(self.vertices)):
+            half_edges = outgoing.get(vertex, ())
+            if len(half_edges) == 2 and vertex not in keep:
+                self._collapse(*half_edges, outgoing=outgoing)
+
+    def _collapse(self, out0, out1, outgoing):
+        # We have a -> v -> b on one side and b -> v -> a on the other. We
+        # stretch the edge to a across to b and throw the edge to b away.
+        in0 = out0 ^ 1
+        in1 = out1 ^ 1
+        vertex = self.origins[out0]
+        a = self.origins[in0]
+        b = self.origins[in1]
+        if (a, b) in self._half_edges:
+            # Merging would give us two edges between the same vertices.
+            return
+        self.origins[out0] = b
+        del outgoing[vertex]
+        outgoing[b][outgoing[b].index(in1)] = out0
+
+        following = self.next[out1]
+        self.next[in0] = following
+        if following != NO_HALF_EDGE:
+            self.prev[following] = in0
+        preceding = self.prev[in1]
+        self.prev[out0] = preceding
+        if preceding != NO_HALF_EDGE:
+            self.next[preceding] = out0
+
+        for merged, dropped in ((in0, out1), (out0, in1)):
+            cell = self.cells[dropped]
+            if self._cell_half_edges.get(cell) == dropped:
+                self._cell_half_edges[cell] = merged
+            self.origins[dropped] = NO_HALF_EDGE
+            self.next[dropped] = NO_HALF_EDGE
+            self.prev[dropped] = NO_HALF_EDGE
+        for key in ((a, vertex), (vertex, a), (vertex, b), (b, vertex)):
+            del self._half_edges[key]
+        self._half_edges[(a, b)] = in0
+        self._half_edges[(b, a)] = out0
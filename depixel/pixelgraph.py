@@ -0,0 +1,457 @@
+# -*- test-case-name: depixel.tests.test_pixelgraph -*-
+
+"""
+A compact, array-backed pixel connectivity graph.
+
+The general-purpose `networkx` graph needs a dict per node and another per
+edge, which adds up to a lot of memory and time for even modestly sized
+images. Pixel connectivity is much simpler than a general graph, though: each
+pixel can only ever be connected to its eight neighbours. We can therefore
+store the whole graph as a single byte per pixel, with one bit per neighbour.
+
+The masks are built a whole image at a time by comparing the pixel data
+against shifted copies of itself, so we avoid per-pixel method calls.
+"""
+
+from array import array
+from itertools import chain, compress, repeat
+from operator import and_, eq, ge, sub
+
+from depixel.mesh import lattice_vertex
+
+
+# Neighbour offsets, indexed by bit number. Opposite directions are four bits
+# apart and diagonals are the odd bits.
+NEIGHBOURS = (
+    (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+E, SE, S, SW, W, NW, N, NE = range(8)
+
+# We only need to compare each pixel with half its neighbours, because the
+# other half are covered by comparing from the other end.
+FORWARD_DIRECTIONS = (E, SE, S, NE)
+
+# The maximum Y, U and V differences for two pixels to be considered similar.
+# These are the thresholds used by hqx, as suggested in the paper.
+YUV_THRESHOLDS = (48, 7, 6)
+
+# Neighbour offsets and neighbour counts for every possible mask.
+MASK_OFFSETS = tuple(
+    tuple(offset for bit, offset in enumerate(NEIGHBOURS) if mask >> bit & 1)
+    for mask in range(256))
+MASK_DEGREES = tuple(len(offsets) for offsets in MASK_OFFSETS)
+
+
+def opposite(direction):
+    return (direction + 4) % 8
+
+
+def direction_between(pix0, pix1):
+    """
+    Find the direction from one pixel to a neighbouring pixel.
+    """
+    return NEIGHBOURS.index((pix1[0] - pix0[0], pix1[1] - pix0[1]))
+
+
+def shifted_rows(rows, direction, func=eq, fill=False):
+    """
+    Apply `func` to each value and its neighbour in the given direction.
+
+    The direction must be one of `FORWARD_DIRECTIONS`. The result has the same
+    shape as `rows`, with `fill` wherever the neighbour is out of bounds.
+    """
+    dx, dy = NEIGHBOURS[direction]
+    size_x = len(rows[0])
+    empty_row = [fill] * size_x
+    if dy == 1:
+        pairs = zip(rows, rows[1:])
+    elif dy == -1:
+        pairs = zip(rows[1:], rows)
+    else:
+        pairs = zip(rows, rows)
+
+    shifted = [list(map(func, row, other[dx:])) + [fill] * dx
+               for row, other in pairs]
+
+    if dy == 1:
+        shifted.append(empty_row)
+    elif dy == -1:
+        shifted.insert(0, empty_row)
+    return shifted
+
+
+def match_masks(pixels, func=eq):
+    """
+    Build boolean match masks for all forward directions.
+
+    Returns a dict mapping each of `FORWARD_DIRECTIONS` to rows of booleans
+    that indicate whether each pixel matches its neighbour in that direction.
+    """
+    return dict((direction, shifted_rows(pixels, direction, func))
+                for direction in FORWARD_DIRECTIONS)
+
+
+def rgb_to_yuv(value):
+    """
+    Convert a pixel value to YUV.
+
+    Values are either RGB tuples or monochrome values normalised to [0, 1].
+    """
+    if isinstance(value, (tuple, list)):
+        r, g, b = value[:3]
+    else:
+        r = g = b = 255 * value
+    return (0.299 * r + 0.587 * g + 0.114 * b,
+            -0.169 * r - 0.331 * g + 0.5 * b,
+            0.5 * r - 0.419 * g - 0.081 * b)
+
+
+def yuv_planes(pixels, to_yuv=rgb_to_yuv):
+    """
+    Split the pixel data into separate Y, U and V planes.
+
+    Each distinct pixel value is only converted once.
+    """
+    yuvs = {}
+    for value in set(chain.from_iterable(pixels)):
+        yuvs[value] = to_yuv(value)
+    return [[[yuvs[value][channel] for value in row] for row in pixels]
+            for channel in range(3)]
+
+
+def similarity_masks(pixels, thresholds=YUV_THRESHOLDS, to_yuv=rgb_to_yuv):
+    """
+    Build match masks by comparing pixels in YUV space.
+
+    Two pixels match if the differences between their Y, U and V components
+    are all within the given thresholds. This is the same format as
+    `match_masks`, but it lets slightly different colours (from antialiasing
+    or lossy compression, for example) be treated as the same.
+    """
+    planes = yuv_planes(pixels, to_yuv)
+    masks = {}
+    for direction in FORWARD_DIRECTIONS:
+        rows = None
+        for plane, threshold in zip(planes, thresholds):
+            # Out of bounds neighbours are infinitely different.
+            diffs = shifted_rows(plane, direction, sub, float('inf'))
+            similar = [list(map(ge, repeat(threshold), map(abs, row)))
+                       for row in diffs]
+            if rows is None:
+                rows = similar
+            else:
+                rows = [list(map(and_, row0, row1))
+                        for row0, row1 in zip(rows, similar)]
+        masks[direction] = rows
+    return masks
+
+
+def classify_blocks(masks):
+    """
+    Find all 2x2 pixel blocks with crossing diagonals.
+
+    Returns a list of fully-connected blocks and a list of ambiguous
+    (checkerboard) blocks, each identified by the coordinates of its top-left
+    pixel. Blocks without crossing diagonals are never looked at individually,
+    so the cost of this depends mostly on the number of interesting blocks.
+
+    With exact matching, a block with crossing diagonals has either all or
+    none of its orthogonal edges. Similarity matching isn't transitive, so we
+    can get other layouts as well. If the orthogonal edges connect all four
+    pixels, we treat the block as fully connected. Otherwise it's ambiguous.
+    """
+    east, south = masks[E], masks[S]
+    south_east, north_east = masks[SE], masks[NE]
+    full_blocks = []
+    ambiguous_blocks = []
+
+    for y in range(len(south_east) - 1):
+        # The padding on the end of each row means we never find a crossing
+        # in the last column.
+        crossings = map(and_, south_east[y], north_east[y + 1])
+        for x in compress(range(len(south_east[y])), crossings):
+            orthogonals = sum((east[y][x], south[y][x],
+                               south[y][x + 1], east[y + 1][x]))
+            if orthogonals >= 3:
+                full_blocks.append((x, y))
+            else:
+                ambiguous_blocks.append((x, y))
+
+    return full_blocks, ambiguous_blocks
+
+
+def block_diagonals(block):
+    """
+    Get the two diagonal edges of the 2x2 block with the given top-left pixel.
+    """
+    x, y = block
+    return (((x, y), (x + 1, y + 1)), ((x + 1, y), (x, y + 1)))
+
+
+def _or_bytes(data0, data1):
+    # Doing this through big integers is much faster than looping in Python.
+    return (int.from_bytes(data0, 'big') | int.from_bytes(data1, 'big')
+            ).to_bytes(len(data0), 'big')
+
+
+def _shift_bytes(data, offset):
+    if offset > 0:
+        return bytes(offset) + data[:-offset]
+    return data[-offset:] + bytes(-offset)
+
+
+def build_links(size, masks):
+    """
+    Combine match masks into a per-pixel neighbour bitmask.
+    """
+    size_x, size_y = size
+    links = bytes(size_x * size_y)
+    for direction, rows in masks.items():
+        dx, dy = NEIGHBOURS[direction]
+        matched = bytes(chain.from_iterable(rows))
+        forward = matched.translate(
+            bytes.maketrans(b'\x01', bytes([1 << direction])))
+        backward = _shift_bytes(matched, dy * size_x + dx).translate(
+            bytes.maketrans(b'\x01', bytes([1 << opposite(direction)])))
+        links = _or_bytes(_or_bytes(links, forward), backward)
+    return bytearray(links)
+
+
+def label_components(size, links):
+    """
+    Label the connected components of a pixel graph.
+
+    This is a single union-find pass over the links, followed by a pass to
+    give each component a label. Components are labelled in the order their
+    first pixels appear, counting along each row in turn.
+
+    Returns the labels as an array with one entry per pixel, and the number
+    of components.
+    """
+    size_x = size[0]
+    num_pixels = size_x * size[1]
+    parents = array('l', range(num_pixels))
+    forward = ((1 << E, 1), (1 << SE, size_x + 1), (1 << S, size_x),
+               (1 << SW, size_x - 1))
+    forward_mask = sum(bit for bit, _ in forward)
+
+    def find(index):
+        while parents[index] != index:
+            # Path halving keeps the trees nice and flat.
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for index, mask in enumerate(links):
+        if not mask & forward_mask:
+            continue
+        for bit, offset in forward:
+            if mask & bit:
+                root0 = find(index)
+                root1 = find(index + offset)
+                # The smallest index is always the root, so it's the first
+                # pixel in the component.
+                if root0 < root1:
+                    parents[root1] = root0
+                elif root1 < root0:
+                    parents[root0] = root1
+
+    labels = array('l', bytes(num_pixels * array('l').itemsize))
+    num_labels = 0
+    for index in range(num_pixels):
+        root = find(index)
+        if root == index:
+            labels[index] = num_labels
+            num_labels += 1
+        else:
+            labels[index] = labels[root]
+    return labels, num_labels
+
+
+def default_corners(node):
+    """
+    Get the corners of an undeformed pixel, in lattice coordinates.
+    """
+    x, y = node
+    return set(lattice_vertex(corner) for corner in (
+        (x, y), (x + 1, y), (x, y + 1), (x + 1, y + 1)))
+
+
+class NodeView(object):
+    """
+    Just enough of the `networkx` node view for our purposes.
+    """
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __call__(self, data=False):
+        if data:
+            return [(node, self[node]) for node in self._graph]
+        return list(self._graph)
+
+    def __iter__(self):
+        return iter(self._graph)
+
+    def __len__(self):
+        return len(self._graph)
+
+    def __contains__(self, node):
+        return node in self._graph
+
+    def __getitem__(self, node):
+        return self._graph.node_attrs(node)
+
+
+class PixelGraph(object):
+    """
+    A pixel connectivity graph stored as one neighbour bitmask per pixel.
+
+    This implements the subset of the `networkx.Graph` API that the rest of
+    the depixeling code uses. Node and edge attributes are only created when
+    they are asked for, so we don't pay for them on the vast majority of
+    pixels that nobody ever looks at.
+
+    :param pixels: A 2d array of pixel values.
+    :param links: A bytearray of neighbour bitmasks, one per pixel.
+    """
+
+    def __init__(self, pixels, links):
+        self.pixels = pixels
+        self.size_x = len(pixels[0])
+        self.size_y = len(pixels)
+        self.size = (self.size_x, self.size_y)
+        self.links = links
+        self.nodes = NodeView(self)
+        self.corners = default_corners
+        self._node_attrs = {}
+        self._edge_attrs = {}
+
+    @classmethod
+    def from_pixels(cls, pixels, func=eq):
+        size = (len(pixels[0]), len(pixels))
+        return cls(pixels, build_links(size, match_masks(pixels, func)))
+
+    def _index(self, node):
+        x, y = node
+        if not (0 <= x < self.size_x and 0 <= y < self.size_y):
+            raise KeyError(node)
+        return y * self.size_x + x
+
+    def __iter__(self):
+        for y in range(self.size_y):
+            for x in range(self.size_x):
+                yield (x, y)
+
+    def __len__(self):
+        return self.size_x * self.size_y
+
+    def __contains__(self, node):
+        try:
+            self._index(node)
+        except (KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    def __getitem__(self, node):
+        return dict((neighbor, self._edge_data(node, neighbor))
+                    for neighbor in self.neighbors(node))
+
+    def link_mask(self, node):
+        return self.links[self._index(node)]
+
+    def window_links(self, origin, size):
+        """
+        Get the link masks for a window of nodes, a row at a time, as bytes.
+
+        Parts of the window outside the image have no links.
+        """
+        min_x, min_y = origin
+        size_x, size_y = size
+        lo_x = min(max(min_x, 0), self.size_x)
+        hi_x = max(min(min_x + size_x, self.size_x), lo_x)
+        pad_lo = bytes(lo_x - min_x) if lo_x > min_x else b''
+        pad_hi = bytes(size_x - len(pad_lo) - (hi_x - lo_x))
+        rows = []
+        for y in range(min_y, min_y + size_y):
+            if 0 <= y < self.size_y and hi_x > lo_x:
+                start = y * self.size_x
+                rows.extend(
+                    [pad_lo, self.links[start + lo_x:start + hi_x], pad_hi])
+            else:
+                rows.append(bytes(size_x))
+        return b''.join(rows)
+
+    def neighbors(self, node):
+        x, y = node
+        return [(x + dx, y + dy)
+                for dx, dy in MASK_OFFSETS[self.link_mask(node)]]
+
+    def degree(self, node):
+        return MASK_DEGREES[self.link_mask(node)]
+
+    def has_edge(self, pix0, pix1):
+        try:
+            direction = direction_between(pix0, pix1)
+            return bool(self.link_mask(pix0) >> direction & 1)
+        except (KeyError, ValueError):
+            return False
+
+    def remove_edge(self, pix0, pix1):
+        if not self.has_edge(pix0, pix1):
+            raise KeyError(
+                "The edge %s-%s is not in the graph." % (pix0, pix1))
+        direction = direction_between(pix0, pix1)
+        self.links[self._index(pix0)] &= ~(1 << direction) & 0xff
+        self.links[self._index(pix1)] &= ~(1 << opposite(direction)) & 0xff
+        self._edge_attrs.pop(tuple(sorted((pix0, pix1))), None)
+
+    def node_attrs(self, node):
+        attrs = self._node_attrs.get(node)
+        if attrs is None:
+            attrs = {
+                'value': self.pixels[node[1]][node[0]],
+                'corners': self.corners(node),
+                }
+            self._node_attrs[node] = attrs
+        return attrs
+
+    def set_corners(self, corners):
+        """
+        Get each pixel's corners from `corners(node)` from now on.
+
+        Only the pixels somebody has already looked at get their new corners
+        straight away. The rest wait until they're asked for.
+        """
+        self.corners = corners
+        for node, attrs in self._node_attrs.items():
+            attrs['corners'] = corners(node)
+
+    def _edge_data(self, pix0, pix1):
+        edge = tuple(sorted((pix0, pix1)))
+        attrs = self._edge_attrs.get(edge)
+        if attrs is None:
+            attrs = {'diagonal': pix0[0] != pix1[0] and pix0[1] != pix1[1]}
+            self._edge_attrs[edge] = attrs
+        return attrs
+
+    def edges(self, nbunch=None, data=False):
+        """
+        List edges, optionally limited to those touching the nodes in nbunch.
+        """
+        if nbunch is None:
+            nbunch = self
+        elif nbunch in self:
+            nbunch = [nbunch]
+
+        edges = []
+        seen = set()
+        for node in nbunch:
+            seen.add(node)
+            for neighbor in self.neighbors(node):
+                if neighbor in seen:
+                    continue
+                if data:
+                    edges.append(
+                        (node, neighbor, self._edge_data(node, neighbor)))
+                else:
+                    edges.append((node, neighbor))
+        return edges
@@ -4,7 +4,7 @@ from optparse import OptionParser
 import os.path
 
 from depixel import io_data
-from depixel.depixeler import PixelData
+from depixel.depixeler import PixelData, BACKGROUND_FROM_BORDER
 
 
 def parse_options():
@@ -23,6 +23,17 @@ def parse_options():
                       dest="to_png", action="store_true", default=False)
     parser.add_option('--to-svg', help="Write SVG output.",
                       dest="to_svg", action="store_true", default=False)
+    parser.add_option('--similar', help="Match similar colours, not just "
+                      "identical ones.", dest="similarity",
+                      action="store_true", default=None)
+    parser.add_option('--background', metavar='COLOUR', default=None,
+                      help="Background colour as R,G,B, 'border' for the "
+                      "most common colour around the edge of the image or "
+                      "'none' to draw every shape. [255,255,255]",
+                      dest="background", action="store")
+    parser.add_option('--jobs', metavar='N', type='int', default=None,
+                      help="Number of processes to smooth splines in, or 0 "
+                      "for one per CPU. [1]", dest="jobs", action="store")
     parser.add_option('--output-dir', metavar='DIR', default=".",
                       help="Directory for output files. [%default]",
                       dest="output_dir", action="store")
@@ -30,13 +41,26 @@ def parse_options():
     options, args = parser.parse_args()
     if not args:
         parser.error("You must provide at least one input file.")
+    if options.jobs is not None and options.jobs < 0:
+        parser.error("Invalid number of jobs: %s" % (options.jobs,))
+    if options.background == 'none':
+        options.background = False
+    elif options.background not in (None, BACKGROUND_FROM_BORDER):
+        try:
+            options.background = tuple(
+                int(c) for c in options.background.split(','))
+        except ValueError:
+            parser.error("Invalid background colour: %s" % (
+                options.background,))
 
     return options, args
 
 
 def process_file(options, filename):
     print("Processing %s..." % (filename,))
-    data = PixelData(io_data.read_pixels(filename, 'png'))
+    pixels, palette = io_data.read_indexed_pixels(filename, 'png')
+    data = PixelData(pixels, palette, similarity=options.similarity,
+                     background=options.background, jobs=options.jobs)
     base_filename = os.path.splitext(os.path.split(filename)[-1])[0]
     outdir = options.output_dir
 
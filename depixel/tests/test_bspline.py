@@ -1,6 +1,15 @@
+import pickle
+import random
+from math import sqrt
 from unittest import TestCase
 
-from depixel.bspline import Point, BSpline
+from depixel.bspline import (
+    Point, BSpline, ClosedBSpline, gauss_legendre, polyline_to_closed_bspline,
+    SplineSmoother, GradientSplineSmoother)
+
+
+OUTLINE = [(0, 0), (1, 0), (2, 0.25), (3, 1), (3, 2), (2.5, 3), (1, 3),
+           (0, 2.5), (-0.5, 1)]
 
 
 def make_oct_spline(p=2, offset_x=0, offset_y=0, scale=50):
@@ -12,6 +21,47 @@ def make_oct_spline(p=2, offset_x=0, offset_y=0, scale=50):
     return BSpline(knots, points, p)
 
 
+def exact_curvature_energy(spline, index):
+    # On a quadratic span, d1 = c1 + 2 * c2 * t and d2 = 2 * c2, so the
+    # curvature is |cross(c1, 2 * c2)| / q(t) ** 1.5 with q(t) = |d1| ** 2,
+    # which we can integrate exactly.
+    energy = 0
+    for span in spline._get_point_spans(index):
+        if span[0] == span[1]:
+            continue
+        k = spline._find_span((span[0] + span[1]) / 2)
+        _, c1, c2 = spline._span_polynomial(k)
+        cross = abs(2 * (c1.real * c2.imag - c1.imag * c2.real))
+        a = 4 * abs(c2) ** 2
+        b = 4 * (c1 * c2.conjugate()).real
+        c = abs(c1) ** 2
+
+        def antiderivative(t):
+            q = a * t * t + b * t + c
+            return 2 * (2 * a * t + b) / ((4 * a * c - b * b) * sqrt(q))
+
+        t0 = span[0] - spline.knots[k]
+        t1 = span[1] - spline.knots[k]
+        energy += cross * (antiderivative(t1) - antiderivative(t0))
+    return energy
+
+
+class TestGaussLegendre(TestCase):
+    def test_weights(self):
+        for order in range(1, 9):
+            rule = gauss_legendre(order)
+            self.assertEqual(order, len(rule))
+            self.assertAlmostEqual(2, sum(w for _, w in rule))
+
+    def test_exact_for_polynomials(self):
+        # An order n rule is exact for polynomials up to degree 2n - 1.
+        for order in range(1, 6):
+            for power in range(2 * order):
+                expected = 0 if power % 2 else 2.0 / (power + 1)
+                self.assertAlmostEqual(expected, sum(
+                    w * x ** power for x, w in gauss_legendre(order)))
+
+
 class TestBSpline(TestCase):
     def test_spline_degree(self):
         knots = [0, 0.25, 0.5, 0.75, 1]
@@ -43,3 +93,279 @@ class TestBSpline(TestCase):
     def test_curvature(self):
         spline = make_oct_spline()
         self.assertEqual(0.005, round(spline.curvature(0.5), 5))
+
+    def test_translated(self):
+        spline = make_oct_spline()
+        moved = spline.translated((10, -5))
+        self.assertEqual(spline.knots, moved.knots)
+        self.assertEqual(make_oct_spline(offset_x=10, offset_y=-5).points,
+                         moved.points)
+        self.assertEqual(Point((160, 295)), moved(0.5).round())
+
+    def test_evaluate(self):
+        spline = make_oct_spline()
+        us = [spline.domain[0], 0.3, 0.5, 0.77, spline.domain[1]]
+        points, d1s, d2s = spline.evaluate(us, 2)
+        deriv = spline.derivative()
+        for u, point, d1, d2 in zip(us, points, d1s, d2s):
+            self.assertAlmostEqual(0, abs(spline(u) - point))
+            self.assertAlmostEqual(0, abs(deriv(u) - d1), 6)
+            self.assertAlmostEqual(0, abs(deriv.derivative()(u) - d2), 3)
+        self.assertEqual(1, len(spline.evaluate(us)))
+
+    def test_evaluate_nonuniform(self):
+        knots = [0, 0.1, 0.15, 0.4, 0.5, 0.8, 0.85, 1]
+        points = [(0, 0), (10, 5), (20, -5), (30, 0), (40, 10)]
+        for degree in (1, 2):
+            spline = BSpline(knots[:len(points) + degree + 1], points)
+            lo, hi = spline.domain
+            us = [lo + (hi - lo) * i / 10.0 for i in range(11)]
+            deriv = spline.derivative()
+            points_, d1s = spline.evaluate(us, 1)
+            for u, point, d1 in zip(us, points_, d1s):
+                self.assertAlmostEqual(0, abs(spline(u) - point))
+                self.assertAlmostEqual(0, abs(deriv(u) - d1), 6)
+
+    def test_curvatures(self):
+        spline = make_oct_spline()
+        us = [0.3, 0.5, 0.6]
+        self.assertEqual([round(spline.curvature(u), 10) for u in us],
+                         [round(c, 10) for c in spline.curvatures(us)])
+
+    def test_quadrature_curvature_energy(self):
+        for spline in (make_oct_spline(scale=1),
+                       polyline_to_closed_bspline(OUTLINE)):
+            for index in range(len(spline.useful_points)):
+                exact = exact_curvature_energy(spline, index)
+                if exact == 0:
+                    continue
+                gauss = spline.quadrature_curvature_energy(index, 8)
+                self.assertAlmostEqual(1, gauss / exact, 6)
+                # Low orders are still closer than the trapezoid rule.
+                trapezoid = spline.curvature_energy(index, 20)
+                gauss = spline.quadrature_curvature_energy(index, 4)
+                self.assertTrue(abs(gauss - exact) < abs(trapezoid - exact))
+                self.assertAlmostEqual(1, trapezoid / exact, 1)
+
+    def test_move_point(self):
+        spline = make_oct_spline()
+        points = spline.points
+        spline.move_point(3, (7, 8))
+        self.assertEqual(Point((7, 8)), spline.points[3])
+        self.assertEqual(7 + 8j, spline.point_value(3))
+        # Points we already had don't change underneath us.
+        self.assertEqual(Point((250, 250)), points[3])
+        spline.move_point(3, Point(1j))
+        self.assertEqual(1j, spline.point_value(3))
+        spline.move_point(3, 2 + 3j)
+        self.assertEqual((2, 3), spline.points[3].tuple)
+
+    def test_pickle(self):
+        spline = polyline_to_closed_bspline(OUTLINE)
+        spline.quadrature_curvature_energy(0, 4)
+        data = pickle.dumps(spline)
+        # The caches stay behind.
+        self.assertTrue(len(data) < len(pickle.dumps(spline.__dict__)))
+        copy = pickle.loads(data)
+        self.assertEqual(spline.point_values(), copy.point_values())
+        self.assertEqual(spline.knots, copy.knots)
+        self.assertEqual(spline.domain, copy.domain)
+        copy.move_point(1, (5, 5))
+        self.assertEqual(5 + 5j, copy.point_value(len(OUTLINE) + 1))
+
+    def test_move_point_updates_caches(self):
+        spline = polyline_to_closed_bspline(OUTLINE)
+        count = len(spline.useful_points)
+        for index in range(count):
+            spline.quadrature_curvature_energy(index, 4)
+        spline.derivative().derivative()
+
+        spline.move_point(4, (3.5, 2.5))
+        # Only the spans the point affects are forgotten.
+        energies = spline._cache['span_energies'][4]
+        self.assertEqual(set(range(2, 11)) - set([4, 5, 6]), set(energies))
+
+        spline.move_point(0, (0.5, -0.5))
+        fresh = spline.copy()
+        for index in range(count):
+            self.assertEqual(fresh.quadrature_curvature_energy(index, 4),
+                             spline.quadrature_curvature_energy(index, 4))
+        self.assertEqual(fresh.derivative().points,
+                         spline.derivative().points)
+        self.assertEqual(fresh.derivative().derivative().points,
+                         spline.derivative().derivative().points)
+
+
+class TestSplineSmoother(TestCase):
+    def make_smoother(self, tolerance):
+        smoother = SplineSmoother(polyline_to_closed_bspline(OUTLINE))
+        smoother.ITERATIONS = 4
+        smoother.POINT_GUESSES = 3
+        smoother.MOVE_TOLERANCE = tolerance
+        return smoother
+
+    def test_full_sweeps(self):
+        random.seed(3)
+        smoother = self.make_smoother(0)
+        smoother.smooth()
+        self.assertEqual({'sweeps': 4, 'evaluations': 4 * 9 * 4,
+                          'evaluations_saved': 0}, smoother.stats())
+
+    def test_dormant_points(self):
+        # Nothing moves far enough to stay active.
+        random.seed(3)
+        smoother = self.make_smoother(1)
+        smoother.smooth()
+        self.assertEqual({'sweeps': 1, 'evaluations': 9 * 4,
+                          'evaluations_saved': 3 * 9 * 4}, smoother.stats())
+
+    def test_candidate_energies(self):
+        random.seed(5)
+        for spline in [polyline_to_closed_bspline(OUTLINE),
+                       make_oct_spline()]:
+            smoother = SplineSmoother(spline)
+            for index in range(len(spline.useful_points)):
+                start = smoother.spline.point_value(index)
+                candidates = [start + smoother._rand() for _ in range(3)]
+                energies = smoother.candidate_energies(index, candidates)
+                for candidate, energy in zip(candidates, energies):
+                    smoother.spline.move_point(index, candidate)
+                    self.assertAlmostEqual(
+                        smoother.point_energy(index), energy)
+                smoother.spline.move_point(index, start)
+
+    def test_smooth_point_picks_best_candidate(self):
+        smoother = self.make_smoother(0)
+        start = smoother.spline.point_value(2)
+        random.seed(7)
+        best = smoother.smooth_point(2, start)
+        self.assertEqual(best, smoother.spline.point_value(2))
+        # Try the same candidates again, one at a time.
+        random.seed(7)
+        candidates = [start] + [start + smoother._rand() for _ in range(3)]
+        energies = []
+        for candidate in candidates:
+            smoother.spline.move_point(2, candidate)
+            energies.append(smoother.point_energy(2))
+        self.assertEqual(candidates[energies.index(min(energies))], best)
+
+    def test_smooth_point_stays_local(self):
+        # Smoothing a point only looks at the spans around it, however long
+        # the spline is, and never builds the whole list of points.
+        lookups = []
+
+        class CountingSpline(ClosedBSpline):
+            @property
+            def points(self):
+                lookups.append(1)
+                return super(CountingSpline, self).points
+
+        spline = polyline_to_closed_bspline(
+            [(i, i % 2) for i in range(1000)])
+        spline = CountingSpline(spline.knots, spline.point_values())
+        smoother = SplineSmoother(spline, 1)
+        smoother.spline._reset_cache()
+        del lookups[:]
+        smoother.smooth_point(5, smoother.spline.point_value(5))
+        self.assertEqual([], lookups)
+        self.assertTrue(
+            len(smoother.spline._cache.get('span_polynomials', {})) <= 3)
+
+    def test_seed(self):
+        spline = polyline_to_closed_bspline(OUTLINE)
+        smooth = []
+        for seed in (1, 1, 2):
+            smoother = SplineSmoother(spline, seed)
+            smoother.ITERATIONS = 2
+            # Nobody else's random numbers make any difference.
+            random.random()
+            smoother.smooth()
+            smooth.append(smoother.spline.point_values())
+        self.assertEqual(smooth[0], smooth[1])
+        self.assertNotEqual(smooth[0], smooth[2])
+
+    def test_neighbours(self):
+        smoother = self.make_smoother(0)
+        self.assertEqual([7, 8, 0, 1, 2], smoother._neighbours(0, 9))
+        smoother = SplineSmoother(make_oct_spline())
+        self.assertEqual([0, 1, 2], list(smoother._neighbours(0, 10)))
+
+
+class TestGradientSplineSmoother(TestCase):
+    def make_smoother(self):
+        smoother = GradientSplineSmoother(polyline_to_closed_bspline(OUTLINE))
+        # Move the points off their original positions so there's some
+        # positional energy too.
+        smoother._move_points([value + 0.05j * (i % 3 - 1)
+                               for i, value in enumerate(smoother._values())])
+        return smoother
+
+    def test_energy(self):
+        smoother = self.make_smoother()
+        smoother.CROSS_SMOOTHING = 0
+        self.assertAlmostEqual(
+            sum(smoother.point_energy(i) for i in range(smoother.count)),
+            smoother.energy())
+
+    def test_gradient(self):
+        smoother = self.make_smoother()
+        values = smoother._values()
+        gradient = smoother.gradient()
+        h = 1e-6
+        for i in range(smoother.count):
+            for direction, expected in ((1, gradient[i].real),
+                                        (1j, gradient[i].imag)):
+                moved = list(values)
+                moved[i] = values[i] + h * direction
+                smoother._move_points(moved)
+                above = smoother.energy()
+                moved[i] = values[i] - h * direction
+                smoother._move_points(moved)
+                below = smoother.energy()
+                self.assertAlmostEqual(expected, (above - below) / (2 * h), 5)
+
+    def test_smooth(self):
+        spline = polyline_to_closed_bspline(OUTLINE)
+        start = GradientSplineSmoother(spline)
+        smoother = GradientSplineSmoother(spline)
+        smoother.smooth()
+        self.assertTrue(smoother.energy() < 0.9 * start.energy())
+        # The random search would try this many places at most.
+        self.assertTrue(smoother.evaluations < smoother.ITERATIONS * (
+            smoother.POINT_GUESSES + 1) * smoother.count)
+        # The original spline is untouched, and we always get the same
+        # answer.
+        self.assertEqual(start._values(), spline.point_values()[:-2])
+        again = GradientSplineSmoother(spline)
+        again.smooth()
+        self.assertEqual(smoother.spline.points, again.spline.points)
+
+    def test_beats_random_search(self):
+        random.seed(3)
+        spline = polyline_to_closed_bspline(OUTLINE)
+        random_smoother = SplineSmoother(spline)
+        random_smoother.smooth()
+        smoother = GradientSplineSmoother(spline)
+        smoother.smooth()
+        total = GradientSplineSmoother(random_smoother.spline)
+        total.origs = smoother.origs
+        # Compare the energies without the kink rounded off.
+        smoother.CROSS_SMOOTHING = total.CROSS_SMOOTHING = 0
+        self.assertTrue(smoother.energy() <= total.energy())
+
+    def test_quadratic_only(self):
+        self.assertRaises(ValueError, GradientSplineSmoother,
+                          make_oct_spline(p=3))
+
+
+class TestPoint(TestCase):
+    def test_arithmetic(self):
+        p = Point((1, 2))
+        self.assertEqual(Point((3, 5)), p + Point((2, 3)))
+        self.assertEqual(Point((0, 2)), p - 1)
+        self.assertEqual(Point((2, 4)), 2 * p)
+        self.assertEqual(Point((0.5, 1)), p / 2)
+        self.assertEqual(5 ** 0.5, abs(p))
+
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, Point((0, 0)), 'z', 1)
@@ -2,9 +2,17 @@ from unittest import TestCase
 
 import networkx as nx
 
-from depixel.depixeler import PixelData
+from depixel import bspline
 from depixel.depixeler import (
-    FullyConnectedHeuristics, IterativeFinalShapeHeuristics)
+    PixelData, Path, TemplatePath, BACKGROUND_FROM_BORDER, control_vertices,
+    cn_edge)
+from depixel.depixeler import (
+    FullyConnectedHeuristics, IterativeFinalShapeHeuristics, vertex_pattern,
+    VERTEX_PATTERNS, NO_DIAGONAL, DIAGONAL_TL_BR, DIAGONAL_TR_BL, EDGE_N,
+    EDGE_S, TL, TR, BL, BR)
+from depixel.io_data import index_pixels
+from depixel.mesh import lattice_vertex
+from depixel.pixelgraph import PixelGraph, E
 
 
 BAR = """
@@ -46,6 +54,22 @@ ISLAND = """
 ..XX
 """
 
+RING = """
+.....
+.XXX.
+.X.X.
+.XXX.
+.....
+"""
+
+SPECKS = """
+......
+.X..o.
+......
+..X...
+......
+"""
+
 CEE = """
 ...............
 ......XXXX..XX.
@@ -109,6 +133,10 @@ def mkpixels(txt_data):
     return pixels
 
 
+def corners(*points):
+    return set(lattice_vertex(point) for point in points)
+
+
 def sort_edges(edges):
     return sorted(tuple(sorted(e[:2])) + e[2:] for e in edges)
 
@@ -127,6 +155,80 @@ class TestUtils(TestCase):
         self.assertEqual(ear_pixels, mkpixels(EAR))
 
 
+class TestVertexPatterns(TestCase):
+    def test_no_diagonal(self):
+        for matches in range(16):
+            corners = vertex_pattern(NO_DIAGONAL, matches)
+            self.assertEqual((((0, 0),),) * 4, corners)
+
+    def test_diagonal(self):
+        corners = vertex_pattern(DIAGONAL_TL_BR, 0)
+        self.assertEqual(((1, -1), (0, 0), (-1, 1)), corners[TL])
+        self.assertEqual(((1, -1),), corners[TR])
+        self.assertEqual(((-1, 1),), corners[BL])
+        self.assertEqual(((-1, 1), (0, 0), (1, -1)), corners[BR])
+
+    def test_partial_cut(self):
+        # Similarity matching can leave a pixel matching only one of the
+        # pixels on the diagonal. It still reaches the vertex along the edge
+        # between them.
+        corners = vertex_pattern(DIAGONAL_TR_BL, 1 << EDGE_N | 1 << EDGE_S)
+        self.assertEqual(((1, 1), (0, 0)), corners[TR])
+        self.assertEqual(((0, 0), (-1, -1)), corners[TL])
+
+    def test_lookup_table(self):
+        self.assertEqual(48, len(VERTEX_PATTERNS))
+        self.assertEqual(vertex_pattern(DIAGONAL_TR_BL, 5),
+                         VERTEX_PATTERNS[DIAGONAL_TR_BL << 4 | 5])
+
+
+class TestControlVertices(TestCase):
+    # A bar five pixels wide and two high, in lattice coordinates.
+    BAR = ([(x, 0) for x in range(0, 20, 4)] + [(20, 0), (20, 4)]
+           + [(x, 8) for x in range(20, 0, -4)] + [(0, 8), (0, 4)])
+    # A four pixel square with its corners cut.
+    CUT_SQUARE = [(0, 4), (1, 1), (4, 0), (8, 0), (12, 0), (15, 1), (16, 4),
+                  (16, 8), (16, 12), (15, 15), (12, 16), (8, 16), (4, 16),
+                  (1, 15), (0, 12), (0, 8)]
+
+    def test_straight_runs(self):
+        # We only keep the ends of each run and the vertices next to them.
+        self.assertEqual(
+            [(0, 0), (4, 0), (16, 0), (20, 0), (20, 4), (20, 8), (16, 8),
+             (4, 8), (0, 8), (0, 4)],
+            control_vertices(self.BAR))
+
+    def test_corners(self):
+        self.assertEqual(
+            [(0, 0), (0, 0), (20, 0), (20, 0), (20, 8), (20, 8), (0, 8),
+             (0, 8)],
+            control_vertices(self.BAR, 8))
+        # The ends are too short to be straight runs of their own, but the
+        # outline turns all the way around in less than the corner length.
+        self.assertEqual(control_vertices(self.BAR, 8),
+                         control_vertices(self.BAR, 12))
+
+    def test_cut_corners(self):
+        control = control_vertices(self.CUT_SQUARE, 8)
+        self.assertEqual(24, len(control))
+        self.assertEqual(
+            [(0, 4), (0, 4), (1, 1), (1, 1), (4, 0), (4, 0), (12, 0)],
+            control[:7])
+        # With longer corners, the sides aren't long enough to count.
+        self.assertEqual(self.CUT_SQUARE,
+                         control_vertices(self.CUT_SQUARE, 12))
+
+    def test_spline(self):
+        path = Path(self.BAR)
+        path.make_spline()
+        self.assertEqual(8, len(path.spline.useful_points))
+        # The corners are on the curve, with straight lines between them.
+        start, end = path.spline.domain
+        us = [start + (end - start) * i / 20.0 for i in range(21)]
+        for point in path.spline.evaluate(us)[0]:
+            self.assertTrue(point.real in (0, 5) or point.imag in (0, 2))
+
+
 class TestFullyConnectedHeuristics(TestCase):
     def get_heuristics(self, txt_data):
         pd = PixelData(mkpixels(txt_data))
@@ -144,6 +246,19 @@ class TestFullyConnectedHeuristics(TestCase):
         self.assertEqual(1, hh.weight_curve(((1, 1), (2, 2))))
         self.assertEqual(8, hh.weight_curve(((1, 2), (2, 1))))
 
+    def test_curve_chains(self):
+        hh = self.get_heuristics(CIRCLE)
+        chain = hh.curve_chains.chain(((1, 2), (2, 1)))
+        self.assertEqual(8, len(chain))
+        for edge in chain:
+            self.assertTrue(hh.curve_chains.chain(edge) is chain)
+
+        # Breaking the circle shortens the curve.
+        hh.remove_edge(((2, 1), (3, 1)))
+        self.assertFalse(hh.pixel_graph.has_edge((2, 1), (3, 1)))
+        self.assertEqual(7, hh.weight_curve(((1, 2), (2, 1))))
+        self.assertEqual(7, hh.weight_curve(((4, 2), (3, 1))))
+
     def test_weight_sparse(self):
         # EAR = """
         # ..... .
@@ -164,11 +279,72 @@ class TestFullyConnectedHeuristics(TestCase):
         self.assertEqual(-4, hh.weight_sparse(((0, 0), (1, 1))))
         self.assertEqual(-9, hh.weight_sparse(((1, 2), (2, 1))))
 
+    def test_sparse_windows(self):
+        hh = self.get_heuristics(PLUS)
+        windows = hh.sparse_windows
+        self.assertEqual((-2, -2), windows.window_origin(((1, 2), (2, 1))))
+        self.assertEqual(windows.window_origin(((1, 1), (2, 2))),
+                         windows.window_origin(((1, 2), (2, 1))))
+        self.assertEqual(9, windows.component_size(((1, 2), (2, 1))))
+        self.assertEqual(4, windows.component_size(((1, 1), (0, 0))))
+
+        # Removing an edge throws away the windows it's in.
+        hh.remove_edge(((2, 1), (2, 0)))
+        self.assertEqual(8, windows.component_size(((1, 2), (2, 1))))
+
+    def test_sparse_windows_whole_components(self):
+        hh = self.get_heuristics(PLUS)
+        windows = hh.sparse_windows
+        self.assertEqual(13, windows.component_size(((1, 1), (2, 2))))
+
+        # A window with a different origin reuses the whole components the
+        # first one found.
+        floods = []
+        label_component = windows._label_component
+        windows._label_component = (
+            lambda *args: floods.append(args[1]) or label_component(*args))
+        self.assertEqual(13, windows.component_size(((1, 1), (2, 0))))
+        self.assertEqual([], floods)
+
+        # Removing an edge throws away the components it's in.
+        hh.remove_edge(((2, 1), (2, 0)))
+        self.assertEqual(5, windows.component_size(((1, 1), (2, 0))))
+        self.assertEqual([(2, 0)], floods)
+
     def test_weight_island(self):
         hh = self.get_heuristics(ISLAND)
         self.assertEqual(5, hh.weight_island(((1, 1), (2, 2))))
         self.assertEqual(0, hh.weight_island(((1, 2), (2, 1))))
 
+    def test_window_patterns(self):
+        checkerboard = [[(x + y) % 2 for x in range(12)] for y in range(12)]
+        for engine in ('networkx', 'array'):
+            pd = PixelData(checkerboard, pixel_graph_engine=engine)
+            pd.make_pixel_graph()
+            hh = FullyConnectedHeuristics(pd.pixel_graph)
+            patterns = hh.window_patterns
+            edges = [((4, 4), (5, 5)), ((5, 5), (6, 6)), ((4, 5), (5, 4))]
+            for edge in edges:
+                self.assertEqual(
+                    (hh.weight_sparse(edge), hh.weight_island(edge)),
+                    hh.weight_window(edge))
+            # The first two edges have the same surroundings.
+            self.assertEqual((1, 2), (patterns.hits, patterns.misses))
+
+            # Removing an edge changes the surroundings.
+            hh.remove_edge(((5, 6), (6, 5)))
+            self.assertEqual(
+                (hh.weight_sparse(edges[1]), hh.weight_island(edges[1])),
+                hh.weight_window(edges[1]))
+            self.assertEqual((1, 3), (patterns.hits, patterns.misses))
+
+    def test_remove_diagonals_keeps_heuristics(self):
+        pd = PixelData(mkpixels(EAR))
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        patterns = pd.heuristics.window_patterns
+        self.assertEqual(4, patterns.hits + patterns.misses)
+
 
 class TestIterativeFinalShapeHeuristics(TestCase):
     def get_heuristics(self, txt_data):
@@ -202,6 +378,79 @@ class TestIterativeFinalShapeHeuristics(TestCase):
         self.assertEqual((5, 5), hh.weight_island(((1, 1), (2, 2))))
         self.assertEqual((0, 0), hh.weight_island(((1, 2), (2, 1))))
 
+    def test_weight_ranges(self):
+        hh = self.get_heuristics(ISLAND)
+        hh.ambiguous.update([((1, 1), (2, 2)), ((1, 2), (2, 1))])
+        # Each diagonal is weighed as if the other one has already gone.
+        self.assertEqual((2, 2), hh.weight_curve(((1, 1), (2, 2))))
+        self.assertEqual((1, 1), hh.weight_curve(((1, 2), (2, 1))))
+        self.assertEqual((-3, -3), hh.weight_sparse(((1, 1), (2, 2))))
+        self.assertEqual((-9, -9), hh.weight_sparse(((1, 2), (2, 1))))
+        self.assertEqual((5, 5), hh.weight_island(((1, 1), (2, 2))))
+        self.assertEqual((0, 0), hh.weight_island(((1, 2), (2, 1))))
+
+        # In a checkerboard, everything depends on the other blocks.
+        checkerboard = [[(x + y) % 2 for x in range(4)] for y in range(4)]
+        hh = IterativeFinalShapeHeuristics(
+            PixelGraph.from_pixels(checkerboard))
+        for x in range(3):
+            for y in range(3):
+                hh.ambiguous.update([((x, y), (x + 1, y + 1)),
+                                     ((x, y + 1), (x + 1, y))])
+        self.assertEqual((1, 9), hh.weight_curve(((1, 1), (2, 2))))
+        self.assertEqual((-8, -2), hh.weight_sparse(((1, 1), (2, 2))))
+        self.assertEqual((0, 5), hh.weight_island(((1, 1), (2, 2))))
+        self.assertEqual((5, 5), hh.weight_island(((0, 0), (1, 1))))
+
+    def test_apply(self):
+        pd = PixelData(mkpixels(ISLAND))
+        pd.HEURISTICS = IterativeFinalShapeHeuristics
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        self.assertFalse(pd.pixel_graph.has_edge((1, 2), (2, 1)))
+        self.assertTrue(pd.pixel_graph.has_edge((1, 1), (2, 2)))
+        for _, _, attrs in pd.pixel_graph.edges(data=True):
+            self.assertEqual(['diagonal'], list(attrs))
+
+    def test_apply_dithered(self):
+        # Every block in a checkerboard is ambiguous, which used to blow up.
+        checkerboard = [[(x + y) % 2 for x in range(12)] for y in range(12)]
+        graphs = []
+        for _ in range(2):
+            pd = PixelData(checkerboard, pixel_graph_engine='array')
+            pd.HEURISTICS = IterativeFinalShapeHeuristics
+            pd.make_pixel_graph()
+            pd.remove_diagonals()
+            graphs.append(sort_edges(pd.pixel_graph.edges()))
+            for x in range(11):
+                for y in range(11):
+                    self.assertFalse(
+                        pd.pixel_graph.has_edge((x, y), (x + 1, y + 1)) and
+                        pd.pixel_graph.has_edge((x + 1, y), (x, y + 1)))
+        self.assertEqual(graphs[0], graphs[1])
+
+    def test_apply_dithered_fallback(self):
+        # Nothing in a checkerboard settles by itself, so pairs get forced
+        # one at a time, always on weights that are still current.
+        forced = []
+
+        class CheckingHeuristics(IterativeFinalShapeHeuristics):
+            def fallback_removals(self, edge1, edge2):
+                weights = (edge1[2]['h_weight'], edge2[2]['h_weight'])
+                self.weight_diagonals(edge1, edge2)
+                forced.append(
+                    weights == (edge1[2]['h_weight'], edge2[2]['h_weight']))
+                return super(CheckingHeuristics, self).fallback_removals(
+                    edge1, edge2)
+
+        checkerboard = [[(x + y) % 2 for x in range(12)] for y in range(12)]
+        pd = PixelData(checkerboard, pixel_graph_engine='array')
+        pd.HEURISTICS = CheckingHeuristics
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        self.assertTrue(forced)
+        self.assertTrue(all(forced))
+
 
 class TestPixelData(TestCase):
     def test_size(self):
@@ -221,29 +470,29 @@ class TestPixelData(TestCase):
         tg = nx.Graph()
         tg.add_nodes_from([
                 ((0, 0), {'value': 1,
-                          'corners': set([(0, 0), (0, 1), (1, 0), (1, 1)])}),
+                          'corners': corners((0, 0), (0, 1), (1, 0), (1, 1))}),
                 ((0, 1), {'value': 1,
-                          'corners': set([(0, 1), (0, 2), (1, 1), (1, 2)])}),
+                          'corners': corners((0, 1), (0, 2), (1, 1), (1, 2))}),
                 ((0, 2), {'value': 1,
-                          'corners': set([(0, 2), (0, 3), (1, 2), (1, 3)])}),
+                          'corners': corners((0, 2), (0, 3), (1, 2), (1, 3))}),
                 ((1, 0), {'value': 1,
-                          'corners': set([(1, 0), (1, 1), (2, 0), (2, 1)])}),
+                          'corners': corners((1, 0), (1, 1), (2, 0), (2, 1))}),
                 ((1, 1), {'value': 0,
-                          'corners': set([(1, 1), (1, 2), (2, 1), (2, 2)])}),
+                          'corners': corners((1, 1), (1, 2), (2, 1), (2, 2))}),
                 ((1, 2), {'value': 1,
-                          'corners': set([(1, 2), (1, 3), (2, 2), (2, 3)])}),
+                          'corners': corners((1, 2), (1, 3), (2, 2), (2, 3))}),
                 ((2, 0), {'value': 1,
-                          'corners': set([(2, 0), (2, 1), (3, 0), (3, 1)])}),
+                          'corners': corners((2, 0), (2, 1), (3, 0), (3, 1))}),
                 ((2, 1), {'value': 1,
-                          'corners': set([(2, 1), (2, 2), (3, 1), (3, 2)])}),
+                          'corners': corners((2, 1), (2, 2), (3, 1), (3, 2))}),
                 ((2, 2), {'value': 0,
-                          'corners': set([(2, 2), (2, 3), (3, 2), (3, 3)])}),
+                          'corners': corners((2, 2), (2, 3), (3, 2), (3, 3))}),
                 ((3, 0), {'value': 1,
-                          'corners': set([(3, 0), (3, 1), (4, 0), (4, 1)])}),
+                          'corners': corners((3, 0), (3, 1), (4, 0), (4, 1))}),
                 ((3, 1), {'value': 1,
-                          'corners': set([(3, 1), (3, 2), (4, 1), (4, 2)])}),
+                          'corners': corners((3, 1), (3, 2), (4, 1), (4, 2))}),
                 ((3, 2), {'value': 0,
-                          'corners': set([(3, 2), (3, 3), (4, 2), (4, 3)])}),
+                          'corners': corners((3, 2), (3, 3), (4, 2), (4, 3))}),
                 ])
         tg.add_edges_from([
                 ((0, 0), (1, 0), {'diagonal': False}),
@@ -276,29 +525,29 @@ class TestPixelData(TestCase):
         tg = nx.Graph()
         tg.add_nodes_from([
                 ((0, 0), {'value': 1,
-                          'corners': set([(0, 0), (0, 1), (1, 0), (1, 1)])}),
+                          'corners': corners((0, 0), (0, 1), (1, 0), (1, 1))}),
                 ((0, 1), {'value': 1,
-                          'corners': set([(0, 1), (0, 2), (1, 1), (1, 2)])}),
+                          'corners': corners((0, 1), (0, 2), (1, 1), (1, 2))}),
                 ((0, 2), {'value': 1,
-                          'corners': set([(0, 2), (0, 3), (1, 2), (1, 3)])}),
+                          'corners': corners((0, 2), (0, 3), (1, 2), (1, 3))}),
                 ((1, 0), {'value': 1,
-                          'corners': set([(1, 0), (1, 1), (2, 0), (2, 1)])}),
+                          'corners': corners((1, 0), (1, 1), (2, 0), (2, 1))}),
                 ((1, 1), {'value': 0,
-                          'corners': set([(1, 1), (1, 2), (2, 1), (2, 2)])}),
+                          'corners': corners((1, 1), (1, 2), (2, 1), (2, 2))}),
                 ((1, 2), {'value': 1,
-                          'corners': set([(1, 2), (1, 3), (2, 2), (2, 3)])}),
+                          'corners': corners((1, 2), (1, 3), (2, 2), (2, 3))}),
                 ((2, 0), {'value': 1,
-                          'corners': set([(2, 0), (2, 1), (3, 0), (3, 1)])}),
+                          'corners': corners((2, 0), (2, 1), (3, 0), (3, 1))}),
                 ((2, 1), {'value': 1,
-                          'corners': set([(2, 1), (2, 2), (3, 1), (3, 2)])}),
+                          'corners': corners((2, 1), (2, 2), (3, 1), (3, 2))}),
                 ((2, 2), {'value': 0,
-                          'corners': set([(2, 2), (2, 3), (3, 2), (3, 3)])}),
+                          'corners': corners((2, 2), (2, 3), (3, 2), (3, 3))}),
                 ((3, 0), {'value': 1,
-                          'corners': set([(3, 0), (3, 1), (4, 0), (4, 1)])}),
+                          'corners': corners((3, 0), (3, 1), (4, 0), (4, 1))}),
                 ((3, 1), {'value': 1,
-                          'corners': set([(3, 1), (3, 2), (4, 1), (4, 2)])}),
+                          'corners': corners((3, 1), (3, 2), (4, 1), (4, 2))}),
                 ((3, 2), {'value': 0,
-                          'corners': set([(3, 2), (3, 3), (4, 2), (4, 3)])}),
+                          'corners': corners((3, 2), (3, 3), (4, 2), (4, 3))}),
                 ])
         tg.add_edges_from([
                 ((0, 0), (1, 0), {'diagonal': False}),
@@ -328,6 +577,39 @@ class TestPixelData(TestCase):
         self.assertEqual(sort_edges(tg.edges(data=True)),
                          sort_edges(pd.pixel_graph.edges(data=True)))
 
+    def test_palette(self):
+        pixels, palette = index_pixels(mkpixels(CEE))
+        self.assertEqual([1, 0, 0.5], palette)
+        pd = PixelData(pixels, palette)
+        self.assertEqual(0, pd.pixel(0, 0))
+        self.assertEqual(1, pd.colour(pd.pixel(0, 0)))
+
+        # We should get the same shapes as we do from the raw values.
+        raw_pd = PixelData(mkpixels(CEE))
+        for data in (pd, raw_pd):
+            data.make_pixel_graph()
+            data.remove_diagonals()
+            data.make_grid_graph()
+            data.deform_grid()
+            data.make_shapes()
+        self.assertEqual(
+            sorted((sorted(s.pixels), pd.colour(s.value)) for s in pd.shapes),
+            sorted((sorted(s.pixels), s.value) for s in raw_pd.shapes))
+
+    def test_match_masks_custom_match(self):
+        class GreyPixelData(PixelData):
+            def match(self, pix0, pix1):
+                return round(self.pixel(*pix0)) == round(self.pixel(*pix1))
+
+        pixels = [[0, 0.25, 1],
+                  [0.75, 1, 1]]
+        masks = PixelData(pixels).match_masks()
+        self.assertEqual([[False, False, False], [False, True, False]],
+                         masks[E])
+        masks = GreyPixelData(pixels).match_masks()
+        self.assertEqual([[True, False, False], [True, True, False]],
+                         masks[E])
+
     def test_deform_grid(self):
         tg = nx.Graph()
         tg.add_nodes_from([
@@ -352,9 +634,186 @@ class TestPixelData(TestCase):
                 ((4, 1), (3, 1)), ((4, 1), (4, 2)), ((4, 2), (4, 3)),
                 ])
 
+        tg = nx.relabel_nodes(tg, lattice_vertex)
+
         pd = PixelData(mkpixels(ISLAND))
         pd.depixel()
 
         self.assertEqual(sorted(tg.nodes()), sorted(pd.grid_graph.nodes()))
         self.assertEqual(sort_edges(tg.edges()),
                          sort_edges(pd.grid_graph.edges()))
+
+    def test_mesh_cells(self):
+        pd = PixelData(mkpixels(ISLAND))
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        pd.deform_grid()
+        grid_graph = pd.grid_graph
+        for pixel, attrs in pd.pixel_graph.nodes(data=True):
+            boundary = pd.mesh.cell_boundary(pixel)
+            self.assertEqual(attrs['corners'], set(boundary))
+            for v0, v1 in zip(boundary, boundary[1:] + boundary[:1]):
+                self.assertTrue(grid_graph.has_edge(v0, v1))
+
+    def test_lazy_corners(self):
+        pd = PixelData(mkpixels(ISLAND), pixel_graph_engine='array')
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        before = pd.pixel_graph.nodes[(1, 1)]
+        pd.deform_grid()
+        # Nobody has asked for anything else yet.
+        self.assertEqual([(1, 1)], list(pd.pixel_graph._node_attrs))
+        self.assertEqual(set(pd.mesh.cell_boundary((1, 1))),
+                         before['corners'])
+        self.assertEqual(set(pd.mesh.cell_boundary((2, 2))),
+                         pd.pixel_graph.nodes[(2, 2)]['corners'])
+
+    def test_isolate_outlines(self):
+        pd = PixelData(mkpixels(ISLAND))
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        pd.deform_grid()
+        pd.make_shapes()
+        pd.isolate_outlines()
+        # The island is a single loop of outline edges, and no outline edge
+        # runs between two of its pixels.
+        [island] = [s for s in pd.shapes if (1, 1) in s.pixels]
+        outline = pd.outlines_graph.subgraph(island.corners)
+        self.assertEqual(1, nx.number_connected_components(outline))
+        self.assertEqual([2], list(set(d for _, d in outline.degree())))
+        for v0, v1, pix0, pix1 in pd.mesh.edges(cells=True):
+            if pix0 in island.pixels and pix1 in island.pixels:
+                self.assertFalse(pd.outlines_graph.has_edge(v0, v1))
+
+    def test_make_shapes(self):
+        for engine in ('networkx', 'array'):
+            pd = PixelData(mkpixels(ISLAND), pixel_graph_engine=engine)
+            pd.make_pixel_graph()
+            pd.remove_diagonals()
+            pd.deform_grid()
+            pd.make_shapes()
+            labels = pd.shape_labels
+            self.assertEqual([9, 3], labels.counts)
+            self.assertEqual([(0, 0, 3, 2), (1, 1, 3, 2)], labels.bboxes)
+            self.assertEqual([1, 0], labels.values)
+            outside, island = pd.shapes
+            self.assertEqual(set([(1, 1), (2, 2), (3, 2)]), island.pixels)
+            self.assertEqual(1, outside.value)
+            self.assertEqual(9, len(outside.pixels))
+            self.assertEqual(
+                set().union(*(pd.pixel_graph.nodes[p]['corners']
+                              for p in island.pixels)),
+                island.corners)
+
+    def test_add_shape_outlines(self):
+        pd = PixelData(mkpixels(RING))
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        pd.deform_grid()
+        pd.make_shapes()
+        pd.add_shape_outlines()
+        outside, ring, inside = pd.shapes
+        self.assertEqual(3, len(pd.paths))
+        # Each hole's outline is also the outline of the shape inside it.
+        self.assertEqual([ring._outside_path], outside._inside_paths)
+        self.assertEqual([inside._outside_path], ring._inside_paths)
+        self.assertEqual([], inside._inside_paths)
+        self.assertEqual(set([outside]), outside._outside_path.shapes)
+        self.assertEqual(set([outside, ring]), ring._outside_path.shapes)
+        self.assertEqual(set([ring, inside]), inside._outside_path.shapes)
+        self.assertEqual(lattice_vertex((0, 0)),
+                         outside._outside_path.path[0])
+        self.assertEqual(set(inside._outside_path.path), inside.corners)
+
+    def test_find_background(self):
+        self.assertEqual((255, 255, 255),
+                         PixelData(mkpixels(RING)).find_background())
+        self.assertEqual(None, PixelData(
+            mkpixels(RING), background=False).find_background())
+        self.assertEqual(0, PixelData(
+            mkpixels(RING), background=0).find_background())
+        self.assertEqual(1, PixelData(
+            mkpixels(RING), background=BACKGROUND_FROM_BORDER
+        ).find_background())
+
+        # The palette maps values to colours.
+        pixels, palette = index_pixels(mkpixels(CEE))
+        pd = PixelData(pixels, palette, background=BACKGROUND_FROM_BORDER)
+        self.assertEqual(1, pd.find_background())
+
+    def test_background_outlines(self):
+        pd = PixelData(mkpixels(RING), background=1)
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        pd.deform_grid()
+        pd.make_shapes()
+        pd.add_shape_outlines()
+        outside, ring, inside = pd.shapes
+        self.assertEqual([True, False, True],
+                         [shape.background for shape in pd.shapes])
+        # Only the image border is skipped. Background shapes still share
+        # the outlines of the shapes they touch.
+        self.assertEqual(2, len(pd.paths))
+        self.assertEqual(None, outside._outside_path)
+        self.assertEqual([ring._outside_path], outside._inside_paths)
+        self.assertEqual(set([outside, ring]), ring._outside_path.shapes)
+        self.assertEqual(set([ring, inside]), inside._outside_path.shapes)
+        # The outside has nothing but the ring's outline to draw.
+        self.assertEqual([ring._outside_path.points], outside.paths)
+        self.assertEqual([ring._outside_path.spline], outside.splines)
+
+    def test_template_paths(self):
+        pd = PixelData(mkpixels(SPECKS))
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        pd.deform_grid()
+        pd.make_shapes()
+        pd.add_shape_outlines()
+        background = pd.shapes[0]
+        self.assertFalse(pd.shape_labels.is_rectangle(0))
+        self.assertFalse(isinstance(background._outside_path, TemplatePath))
+        # Every speck is the same shape, so they all share one template.
+        specks = background._inside_paths
+        self.assertEqual(3, len(specks))
+        self.assertEqual(1, len(pd.path_templates))
+        for path in specks:
+            self.assertTrue(isinstance(path, TemplatePath))
+            self.assertEqual(2, len(path.shapes))
+            expected = bspline.polyline_to_closed_bspline(path.points)
+            self.assertEqual(expected.points, path.spline.points)
+
+    def test_smooth_splines_in_parallel(self):
+        smooth = []
+        for jobs in (1, 2):
+            pd = PixelData(mkpixels(RING), jobs=jobs)
+            pd.depixel()
+            smooth.append(sorted(
+                (path.key(), path.smooth.point_values())
+                for path in pd.paths.values()))
+        # Each path has its own seed, so it doesn't matter where it's done.
+        self.assertEqual(smooth[0], smooth[1])
+
+    def test_gradient_smoother_on_outlines(self):
+        # Traced outlines are full of straight runs, where the curvature
+        # energy has a kink that used to stop the gradient smoother dead.
+        pd = PixelData(mkpixels(INVADER))
+        pd.make_pixel_graph()
+        pd.remove_diagonals()
+        pd.deform_grid()
+        pd.make_shapes()
+        pd.add_shape_outlines()
+        path = max((path for path in pd.paths.values()
+                    if len(path.shapes) > 1), key=lambda path: len(path.path))
+        spline = path.spline
+        start = bspline.GradientSplineSmoother(spline)
+        smoother = bspline.GradientSplineSmoother(spline)
+        smoother.smooth()
+        random_smoother = bspline.SplineSmoother(spline, path.seed())
+        random_smoother.smooth()
+        random_result = bspline.GradientSplineSmoother(random_smoother.spline)
+        random_result.origs = smoother.origs
+        # Compare the energies without the kink rounded off.
+        for result in (start, smoother, random_result):
+            result.CROSS_SMOOTHING = 0
+        self.assertTrue(smoother.energy() < 0.9 * start.energy())
+        self.assertTrue(smoother.energy() < random_result.energy())
@@ -0,0 +1,23 @@
+from unittest import TestCase
+
+from depixel.io_data import index_pixels
+
+
+RED = (255, 0, 0)
+BLUE = (0, 0, 255)
+
+
+class TestIndexPixels(TestCase):
+    def test_index_pixels(self):
+        pixels, palette = index_pixels([[RED, BLUE, RED], [BLUE, BLUE, RED]])
+        self.assertEqual([RED, BLUE], palette)
+        self.assertEqual([[0, 1, 0], [1, 1, 0]], [list(r) for r in pixels])
+        self.assertEqual('B', pixels[0].typecode)
+
+    def test_many_colours(self):
+        colours = [(i % 256, i // 256, 0) for i in range(300)]
+        pixels, palette = index_pixels([colours, colours[::-1]])
+        self.assertEqual(colours, palette)
+        self.assertEqual(list(range(300)), list(pixels[0]))
+        self.assertEqual(list(range(299, -1, -1)), list(pixels[1]))
+        self.assertEqual('H', pixels[0].typecode)
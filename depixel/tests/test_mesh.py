@@ -0,0 +1,127 @@
+from unittest import TestCase
+
+from depixel.mesh import HalfEdgeMesh, lattice_vertex, lattice_point
+
+
+def square(x, y):
+    return [(x, y), (x + 1, y), (x + 1, y + 1), (x, y + 1)]
+
+
+def sort_edges(edges):
+    return sorted(tuple(sorted(e[:2])) + e[2:] for e in edges)
+
+
+class TestHalfEdgeMesh(TestCase):
+    def test_single_cell(self):
+        mesh = HalfEdgeMesh()
+        mesh.add_cell('a', square(0, 0))
+        self.assertEqual(square(0, 0), mesh.cell_boundary('a'))
+        self.assertEqual(4, len(list(mesh.edges())))
+        for v0, v1, cell0, cell1 in mesh.edges(cells=True):
+            self.assertEqual(set(['a', None]), set([cell0, cell1]))
+
+    def test_shared_edge(self):
+        mesh = HalfEdgeMesh()
+        mesh.add_cell('a', square(0, 0))
+        mesh.add_cell('b', square(1, 0))
+        self.assertEqual(7, len(list(mesh.edges())))
+        self.assertEqual(
+            [((1, 0), (1, 1), 'a', 'b')],
+            [e for e in mesh.edges(cells=True) if None not in e[2:]])
+
+    def test_links(self):
+        mesh = HalfEdgeMesh()
+        mesh.add_cell('a', square(0, 0))
+        mesh.add_cell('b', square(1, 0))
+        for half_edge in range(len(mesh.origins)):
+            if mesh.cells[half_edge] is None:
+                continue
+            # Each half-edge ends where the next one starts.
+            self.assertEqual(mesh.origins[half_edge ^ 1],
+                             mesh.origins[mesh.next[half_edge]])
+            self.assertEqual(half_edge, mesh.prev[mesh.next[half_edge]])
+
+    def test_wrong_winding(self):
+        mesh = HalfEdgeMesh()
+        mesh.add_cell('a', square(0, 0))
+        self.assertRaises(
+            ValueError, mesh.add_cell, 'b', list(reversed(square(1, 0))))
+
+    def test_collapse_vertices(self):
+        mesh = HalfEdgeMesh()
+        mesh.add_cell('a', [(0, 0), (1, 0), (2, 0), (2, 1), (0, 1)])
+        mesh.add_cell('b', [(2, 0), (3, 0), (3, 1), (2, 1)])
+        mesh.add_cell('c', [(0, 1), (2, 1), (2, 2), (0, 2)])
+        # (1, 0) is just a kink in the top edge. The other valence-2
+        # vertices are the outside corners, which we keep.
+        mesh.collapse_vertices(
+            keep=[(0, 0), (3, 0), (3, 1), (2, 2), (0, 2)])
+        self.assertEqual([(0, 0), (2, 0), (2, 1), (0, 1)],
+                         mesh.cell_boundary('a'))
+        self.assertEqual([(2, 0), (3, 0), (3, 1), (2, 1)],
+                         mesh.cell_boundary('b'))
+        self.assertEqual(
+            [((0, 0), (0, 1)), ((0, 0), (2, 0)), ((0, 1), (0, 2)),
+             ((0, 1), (2, 1)), ((0, 2), (2, 2)), ((2, 0), (2, 1)),
+             ((2, 0), (3, 0)), ((2, 1), (2, 2)), ((2, 1), (3, 1)),
+             ((3, 0), (3, 1))],
+            sort_edges(mesh.edges()))
+
+    def test_collapse_boundary_start(self):
+        # The cell's boundary starts at the vertex we collapse.
+        mesh = HalfEdgeMesh()
+        mesh.add_cell('a', [(1, 0), (2, 0), (2, 1), (0, 1), (0, 0)])
+        mesh.collapse_vertices(keep=[(0, 0), (2, 0), (2, 1), (0, 1)])
+        boundary = mesh.cell_boundary('a')
+        start = boundary.index((0, 0))
+        self.assertEqual([(0, 0), (2, 0), (2, 1), (0, 1)],
+                         boundary[start:] + boundary[:start])
+
+    def test_boundaries(self):
+        mesh = HalfEdgeMesh()
+        for x in range(3):
+            for y in range(3):
+                mesh.add_cell((x, y), square(x, y))
+        regions = {(1, 1): 'hole'}
+        boundaries = {}
+        twins = []
+        for boundary, twin in mesh.boundaries(
+                lambda cell: regions.get(cell, 'ring')):
+            twins.append(twin)
+            vertices = [mesh.vertices[mesh.origins[half_edge]]
+                        for half_edge in boundary]
+            start = vertices.index(min(vertices))
+            region = regions.get(mesh.cells[boundary[0]], 'ring')
+            boundaries.setdefault(region, []).append(
+                vertices[start:] + vertices[:start])
+        # Boundaries go around their regions the same way as the cells, so
+        # the ring goes around the hole the other way.
+        self.assertEqual([square(1, 1)], boundaries['hole'])
+        inside, outside = sorted(boundaries['ring'], key=len)
+        self.assertEqual([(1, 1), (1, 2), (2, 2), (2, 1)], inside)
+        self.assertEqual(12, len(outside))
+        self.assertEqual([(0, 0), (1, 0), (2, 0), (3, 0)], outside[:4])
+        # The outside boundary comes first, then whichever side of the hole
+        # we find first, and then its twin.
+        self.assertEqual([None, None, 1], twins)
+
+    def test_boundaries_without_twins(self):
+        mesh = HalfEdgeMesh()
+        for x in range(2):
+            for y in range(2):
+                mesh.add_cell((x, y), square(x, y))
+        # The two diagonal regions meet at the middle vertex, so the
+        # boundaries on either side of each edge are all different.
+        boundaries = list(mesh.boundaries(lambda cell: sum(cell) % 2))
+        self.assertEqual(4, len(boundaries))
+        self.assertEqual([None] * 4, [twin for _, twin in boundaries])
+
+class TestLattice(TestCase):
+    def test_lattice_vertex(self):
+        self.assertEqual((4, 8), lattice_vertex((1, 2)))
+        self.assertEqual((5, 7), lattice_vertex((1.25, 1.75)))
+
+    def test_lattice_point(self):
+        self.assertEqual((1.25, 1.75), lattice_point((5, 7)))
+        for vertex in [(0, 0), (3, 9), (13, 2)]:
+            self.assertEqual(vertex, lattice_vertex(lattice_point(vertex)))
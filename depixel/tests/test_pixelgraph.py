@@ -0,0 +1,191 @@
+from unittest import TestCase
+
+from depixel.depixeler import PixelData
+from depixel.pixelgraph import (
+    PixelGraph, shifted_rows, match_masks, similarity_masks, classify_blocks,
+    label_components, rgb_to_yuv, E, SE, S, NE)
+from depixel.tests.test_depixeler import (
+    mkpixels, sort_edges, EAR, ISLAND, CEE, INVADER)
+
+
+def mkgraph(txt_data):
+    return PixelGraph.from_pixels(mkpixels(txt_data))
+
+
+class TestShiftedRows(TestCase):
+    def test_shifted_rows(self):
+        rows = [[1, 0, 1],
+                [1, 1, 0]]
+        self.assertEqual([[False, False, False], [True, False, False]],
+                         shifted_rows(rows, E))
+        self.assertEqual([[True, False, False], [False, False, False]],
+                         shifted_rows(rows, S))
+        self.assertEqual([[True, True, False], [False, False, False]],
+                         shifted_rows(rows, SE))
+        self.assertEqual([[False, False, False], [False, True, False]],
+                         shifted_rows(rows, NE))
+
+
+BLACK = (0, 0, 0)
+DARK = (20, 20, 20)
+RED = (200, 0, 0)
+DARK_RED = (190, 0, 0)
+
+
+class TestSimilarityMasks(TestCase):
+    def test_rgb_to_yuv(self):
+        self.assertEqual((0, 0, 0), rgb_to_yuv(BLACK))
+        y, u, v = rgb_to_yuv((255, 255, 255))
+        self.assertEqual((255, 0, 0), (round(y), round(u), round(v)))
+        self.assertEqual(rgb_to_yuv((255, 255, 255)), rgb_to_yuv(1))
+
+    def test_similarity_masks(self):
+        pixels = [[BLACK, DARK, RED],
+                  [DARK, RED, DARK_RED]]
+        masks = similarity_masks(pixels)
+        self.assertEqual([[True, False, False], [False, True, False]],
+                         masks[E])
+        self.assertEqual([[True, False, True], [False, False, False]],
+                         masks[S])
+        self.assertEqual([[False, False, False], [False, False, False]],
+                         masks[SE])
+        self.assertEqual([[False, False, False], [True, True, False]],
+                         masks[NE])
+        self.assertEqual(match_masks(pixels)[E], similarity_masks(
+            pixels, thresholds=(0, 0, 0))[E])
+
+    def test_similarity_graph(self):
+        pixels = [[BLACK, DARK, RED, RED],
+                  [DARK, BLACK, RED, DARK_RED],
+                  [RED, DARK_RED, BLACK, DARK]]
+        nx_pd = PixelData(pixels, similarity=True)
+        nx_pd.make_pixel_graph()
+        array_pd = PixelData(
+            pixels, pixel_graph_engine='array', similarity=True)
+        array_pd.make_pixel_graph()
+        self.assertEqual(sort_edges(nx_pd.pixel_graph.edges(data=True)),
+                         sort_edges(array_pd.pixel_graph.edges(data=True)))
+        self.assertEqual(2, label_components(
+            array_pd.size, array_pd.pixel_graph.links)[1])
+        self.assertTrue(nx_pd.match((0, 0), (1, 1)))
+        self.assertFalse(nx_pd.match((0, 0), (2, 0)))
+
+
+class TestClassifyBlocks(TestCase):
+    def test_classify_blocks(self):
+        # ISLAND has a single checkerboard block.
+        self.assertEqual(([(2, 0)], [(1, 1)]),
+                         classify_blocks(match_masks(mkpixels(ISLAND))))
+
+    def test_fully_connected(self):
+        pixels = [[0, 0, 1],
+                  [0, 0, 1],
+                  [1, 1, 0]]
+        self.assertEqual(([(0, 0)], [(1, 1)]),
+                         classify_blocks(match_masks(pixels)))
+
+    def test_partially_connected(self):
+        # Similarity matching can give us crossing diagonals with some
+        # orthogonal edges as well.
+        grey = lambda g: (g, g, g)
+        pixels = [[grey(50), grey(47)],
+                  [grey(5), grey(95)]]
+        self.assertEqual(([(0, 0)], []),
+                         classify_blocks(similarity_masks(pixels)))
+        pixels = [[grey(50), grey(10)],
+                  [grey(10), grey(90)]]
+        self.assertEqual(([], [(0, 0)]),
+                         classify_blocks(similarity_masks(pixels)))
+
+    def test_no_crossings(self):
+        pixels = [[0, 1, 0],
+                  [0, 1, 0]]
+        self.assertEqual(([], []), classify_blocks(match_masks(pixels)))
+
+
+class TestPixelGraph(TestCase):
+    def test_matches_networkx_graph(self):
+        for txt_data in (EAR, ISLAND, CEE, INVADER):
+            pd = PixelData(mkpixels(txt_data))
+            pd.make_pixel_graph()
+            pg = mkgraph(txt_data)
+            self.assertEqual(sort_edges(pd.pixel_graph.edges(data=True)),
+                             sort_edges(pg.edges(data=True)))
+            self.assertEqual(sorted(pd.pixel_graph.nodes(data=True)),
+                             sorted(pg.nodes(data=True)))
+
+    def test_neighbors(self):
+        pg = mkgraph(ISLAND)
+        self.assertEqual([(2, 2)], pg.neighbors((1, 1)))
+        self.assertEqual(1, pg.degree((1, 1)))
+        self.assertEqual(sorted([(0, 0), (2, 0), (0, 1), (2, 1)]),
+                         sorted(pg.neighbors((1, 0))))
+        self.assertEqual(4, pg.degree((1, 0)))
+        self.assertEqual(4, len(pg[(1, 0)]))
+
+    def test_edges_nbunch(self):
+        pg = mkgraph(ISLAND)
+        block = [(1, 1), (2, 1), (1, 2), (2, 2)]
+        self.assertEqual(
+            [((1, 1), (2, 2), {'diagonal': True}),
+             ((1, 2), (2, 1), {'diagonal': True})],
+            sort_edges(e for e in pg.edges(block, data=True)
+                       if e[0] in block and e[1] in block))
+
+    def test_remove_edge(self):
+        pg = mkgraph(ISLAND)
+        self.assertTrue(pg.has_edge((1, 2), (2, 1)))
+        self.assertTrue(pg.has_edge((2, 1), (1, 2)))
+        pg.remove_edge((2, 1), (1, 2))
+        self.assertFalse(pg.has_edge((1, 2), (2, 1)))
+        self.assertFalse(pg.has_edge((2, 1), (1, 2)))
+        self.assertEqual([(0, 1), (0, 2)], sorted(pg.neighbors((1, 2))))
+        self.assertRaises(KeyError, pg.remove_edge, (1, 2), (2, 1))
+
+    def test_has_edge_out_of_bounds(self):
+        pg = mkgraph(ISLAND)
+        self.assertFalse(pg.has_edge((0, 0), (-1, 0)))
+        self.assertFalse(pg.has_edge((0, 0), (2, 2)))
+
+    def test_window_links(self):
+        pg = mkgraph(ISLAND)
+        links = pg.window_links((-1, -1), (3, 3))
+        self.assertEqual(bytes(4), links[:4])
+        self.assertEqual(bytes([pg.link_mask((0, 0)), pg.link_mask((1, 0))]),
+                         links[4:6])
+        self.assertEqual(
+            bytes([0, pg.link_mask((0, 1)), pg.link_mask((1, 1))]), links[6:])
+        self.assertEqual(bytes(4), pg.window_links((4, 0), (2, 2)))
+
+    def test_label_components(self):
+        pg = mkgraph(ISLAND)
+        labels, num_labels = label_components((4, 3), pg.links)
+        self.assertEqual(2, num_labels)
+        self.assertEqual([0, 0, 0, 0,
+                          0, 1, 0, 0,
+                          0, 0, 1, 1], list(labels))
+
+
+class TestArrayEngine(TestCase):
+    def test_engine_selection(self):
+        pd = PixelData(mkpixels(ISLAND), pixel_graph_engine='array')
+        pd.make_pixel_graph()
+        self.assertTrue(isinstance(pd.pixel_graph, PixelGraph))
+
+        pd = PixelData(mkpixels(ISLAND), pixel_graph_engine='bogus')
+        self.assertRaises(ValueError, pd.make_pixel_graph)
+
+    def test_deform_grid(self):
+        nx_pd = PixelData(mkpixels(EAR))
+        array_pd = PixelData(mkpixels(EAR), pixel_graph_engine='array')
+        for pd in (nx_pd, array_pd):
+            pd.make_pixel_graph()
+            pd.remove_diagonals()
+            pd.make_grid_graph()
+            pd.deform_grid()
+            pd.make_shapes()
+        self.assertEqual(sort_edges(nx_pd.grid_graph.edges()),
+                         sort_edges(array_pd.grid_graph.edges()))
+        self.assertEqual(
+            sorted(sorted(s.pixels) for s in nx_pd.shapes),
+            sorted(sorted(s.pixels) for s in array_pd.shapes))